@@ -1,198 +1,305 @@
 import json
-import math
 import argparse
-from collections import defaultdict
+import mmap
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 from tqdm import tqdm
 
-parser = argparse.ArgumentParser(description="Analyze bracketed structure statistics from a sequence file.")
-parser.add_argument("--input", "-i", required=True, help="Input file path (sequence format)")
-parser.add_argument("--output", "-o", required=True, help="Output JSON file path")
-args = parser.parse_args()
-
-input_file = args.input
-output_file = args.output
-
-depth_counter = defaultdict(int)
-leaf_counter = defaultdict(int)
-width_counter = defaultdict(int)
-branch_avg_counter = defaultdict(int)
-branch_var_counter = defaultdict(int)
-branch_std_counter = defaultdict(int)
-symmetry_counter = defaultdict(int)
-
-def get_nesting_depth(seq_line):
-    nums = seq_line.strip().split()
-    stack = []
-    max_depth = 0
-    for num in nums:
-        if stack and stack[-1] == num:
-            stack.pop()
-        else:
-            stack.append(num)
-            max_depth = max(max_depth, len(stack))
-    return max_depth
-
-def count_leaf_nodes(seq_line):
-    tokens = seq_line.strip().split()
-    stack = []
-    leaf_count = 0
-    for i, token in enumerate(tokens):
-        if not token.isdigit():
-            continue
-        if stack and stack[-1][0] == token:
-            token_id, open_idx = stack.pop() 
-            if i - open_idx == 1:
-                leaf_count += 1
-        else:
-            stack.append((token, i))
-    return leaf_count
-
-
-def compute_width(seq_line):
-    tokens = seq_line.strip().split()
-    stack = []
-    max_width = 0
-    for token in tokens:
-        if not token.isdigit():
-            continue
-        if stack and stack[-1] == token:
-            stack.pop()
-        else:
-            stack.append(token)
-            max_width = max(max_width, len(stack))
-    return max_width
-
-def compute_branching_factors(seq_line):
-    tokens = seq_line.strip().split()
-    stack = []
-    children = {}
-    for i, token in enumerate(tokens):
-        if not token.isdigit():
-            continue
-        if stack and stack[-1][0] == token:
-            stack.pop()
-        else:
-            stack.append((token, i))
-            if len(stack) >= 2:
-                parent_id, _ = stack[-2]
-                children.setdefault(parent_id, 0)
-                children[parent_id] += 1
-    if not children:
-        return 0.0, 0.0, 0.0
-    counts = list(children.values())
-    avg = sum(counts) / len(counts)
-    var = sum((x - avg) ** 2 for x in counts) / len(counts)
-    std = math.sqrt(var)
-    return avg, var, std
-
-def compute_symmetry_score(seq_line):
-    tokens = seq_line.strip().split()
-    stack = []
-    spans = []
-    for i, token in enumerate(tokens):
-        if not token.isdigit():
-            continue
-        if stack and stack[-1][0] == token:
-            open_token, start = stack.pop()
-            spans.append((start, i))
-        else:
-            stack.append((token, i))
-    if not spans:
-        return 0.0
-    symmetric_count = 0
-    total_count = 0
-    for start, end in spans:
-        if end - start <= 2:
-            continue
-        sub = tokens[start + 1:end]
-        if sub == sub[::-1]:
-            symmetric_count += 1
-        total_count += 1
-    if total_count == 0:
-        return 0.0
-    return round(symmetric_count / total_count, 4)
-
-def remove_crossing_tags(tag_sequence_str):
-    tags = tag_sequence_str.split()
-    
-    from collections import defaultdict
-    tag_positions = defaultdict(list)
-
-    for idx, tag in enumerate(tags):
-        tag_positions[tag].append(idx)
-
-    tag_intervals = defaultdict(list)
-    for tag, positions in tag_positions.items():
-        if len(positions) % 2 != 0:
-            # print(f"⚠️ Tag {tag} appears {len(positions)} times, not an even number. Ignoring.")
+from crossing import crossing_arc_mask
+
+BLOCK_LINES = 4096
+CHUNK_BYTES = 64 * 1024 * 1024
+HISTOGRAMS = ["depth", "leaves", "width", "branch_avg", "branch_var", "branch_std", "symmetry"]
+
+def parse_lines(lines):
+    """Parses a block of lines into one array of token ids padded with -1 to the longest line, and the line lengths."""
+    split = [line.split() for line in lines]
+    lengths = np.array([len(tokens) for tokens in split], dtype=np.int64)
+    tokens = np.full((len(lines), lengths.max(initial=0)), -1, dtype=np.int64)
+    tokens[np.arange(tokens.shape[1]) < lengths[:, None]] = np.array(
+        [token for line_tokens in split for token in line_tokens], dtype=np.int64
+    )
+    return tokens, lengths
+
+def remove_crossing_tags(tokens, lengths):
+    """
+    Pairs up the occurrences of every tag of a line in order (tags that occur an odd number of times are ignored),
+    and drops the tags whose spans cross another span from the line. Works on a whole padded block at once, returning
+    the compacted block, its new lengths and the number of dropped tags of every line.
+    """
+    rows, cols = np.nonzero(np.arange(tokens.shape[1]) < lengths[:, None])
+    tags = tokens[rows, cols]
+
+    # group the occurrences by (line, tag); the sort is stable, so each group stays in position order
+    order = np.argsort(rows * (tags.max(initial=0) + 1) + tags, kind="stable")
+    rows, cols, tags = rows[order], cols[order], tags[order]
+    group_starts = np.flatnonzero(np.r_[True, (rows[1:] != rows[:-1]) | (tags[1:] != tags[:-1])])
+    group_sizes = np.diff(np.r_[group_starts, len(rows)])
+    groups = np.repeat(np.arange(len(group_starts)), group_sizes)
+    ranks = np.arange(len(rows)) - group_starts[groups]
+
+    # occurrences 2k and 2k + 1 of a tag with an even count span an arc
+    firsts = np.flatnonzero((group_sizes[groups] % 2 == 0) & (ranks % 2 == 0))
+    crossing = crossing_arc_mask(rows[firsts], cols[firsts], cols[firsts + 1])
+    crossing_groups = np.unique(groups[firsts[crossing]])
+    num_crossing = np.bincount(rows[group_starts[crossing_groups]], minlength=len(tokens))
+
+    # drop every occurrence of the crossing tags and shift the rest of each line to the left
+    keep = np.ones(len(group_starts), dtype=bool)
+    keep[crossing_groups] = False
+    keep = keep[groups]
+    kept = np.zeros(tokens.shape, dtype=bool)
+    kept[rows[keep], cols[keep]] = True
+    new_lengths = kept.sum(axis=1)
+    cleaned = np.full(tokens.shape, -1, dtype=np.int64)
+    cleaned[np.arange(tokens.shape[1]) < new_lengths[:, None]] = tokens[kept]
+    return cleaned, new_lengths, num_crossing
+
+def match_brackets(tokens, lengths):
+    """
+    Parses a padded block of lines as brackets: a token closes the innermost open bracket if it carries the same id,
+    and opens a new one otherwise. The lines are walked together, one position at a time, each with its own stack.
+
+    Returns `match` (for a closing token, the position of its opening token, else -1), `parent` (for an opening
+    token, the id of the enclosing open token, else -1) and the maximum stack size of every line.
+    """
+    num_lines, width = tokens.shape
+    match = np.full((num_lines, width), -1, dtype=np.int64)
+    parent = np.full((num_lines, width), -1, dtype=np.int64)
+    stacks = np.zeros((num_lines, width), dtype=np.int64)
+    depths = np.zeros(num_lines, dtype=np.int64)
+    max_depths = np.zeros(num_lines, dtype=np.int64)
+    for i in range(width):
+        rows = np.flatnonzero(lengths > i)
+        depth = depths[rows]
+        top = np.where(depth > 0, tokens[rows, stacks[rows, np.maximum(depth - 1, 0)]], -1)
+        closes = (depth > 0) & (top == tokens[rows, i])
+
+        popped = rows[closes]
+        depths[popped] -= 1
+        match[popped, i] = stacks[popped, depths[popped]]
+
+        pushed = rows[~closes]
+        parent[pushed, i] = top[~closes]
+        stacks[pushed, depths[pushed]] = i
+        depths[pushed] += 1
+        max_depths[pushed] = np.maximum(max_depths[pushed], depths[pushed])
+    return match, parent, max_depths
+
+def compute_leaf_nodes(match):
+    rows, ends = np.nonzero(match >= 0)
+    leaves = ends - match[rows, ends] == 1
+    return np.bincount(rows[leaves], minlength=len(match))
+
+def compute_branching_factors(parent):
+    # children are counted per parent token id, so repeated ids in a line share one count
+    rows, cols = np.nonzero(parent >= 0)
+    keys = rows * (parent.max(initial=0) + 1) + parent[rows, cols]
+    keys, counts = np.unique(keys, return_counts=True)
+    parent_rows = keys // (parent.max(initial=0) + 1)
+
+    num_parents = np.bincount(parent_rows, minlength=len(parent))
+    has_children = num_parents > 0
+    avg = np.bincount(parent_rows, weights=counts, minlength=len(parent)) / np.maximum(num_parents, 1)
+    var = np.bincount(parent_rows, weights=(counts - avg[parent_rows]) ** 2, minlength=len(parent))
+    var = np.where(has_children, var / np.maximum(num_parents, 1), 0.0)
+    return np.where(has_children, avg, 0.0), var, np.sqrt(var)
+
+def compute_symmetry_scores(tokens, match):
+    # share of spans longer than 2 whose inner tokens read the same backwards, compared from both ends at once
+    rows, ends = np.nonzero(match >= 0)
+    starts = match[rows, ends]
+    spans = ends - starts > 2
+    rows, starts, ends = rows[spans], starts[spans], ends[spans]
+
+    symmetric = np.ones(len(rows), dtype=bool)
+    alive = np.arange(len(rows))
+    offset = 1
+    while len(alive):
+        left, right = starts[alive] + offset, ends[alive] - offset
+        alive = alive[left < right]
+        left, right = starts[alive] + offset, ends[alive] - offset
+        equal = tokens[rows[alive], left] == tokens[rows[alive], right]
+        symmetric[alive[~equal]] = False
+        alive = alive[equal]
+        offset += 1
+
+    total = np.bincount(rows, minlength=len(tokens))
+    symmetric_count = np.bincount(rows[symmetric], minlength=len(tokens))
+    return np.where(total > 0, symmetric_count / np.maximum(total, 1), 0.0)
+
+def read_blocks(lines, block_lines=BLOCK_LINES):
+    block = []
+    for line in lines:
+        if not line.strip():
             continue
-        for i in range(0, len(positions), 2):
-            start, end = sorted((positions[i], positions[i+1]))
-            tag_intervals[tag].append((start, end))
+        block.append(line)
+        if len(block) == block_lines:
+            yield block
+            block = []
+    if block:
+        yield block
+
+def empty_stats():
+    stats = {name: Counter() for name in HISTOGRAMS}
+    stats["crossing"] = 0
+    return stats
+
+def merge_stats(stats, other):
+    for name in HISTOGRAMS:
+        stats[name].update(other[name])
+    stats["crossing"] += other["crossing"]
+    return stats
+
+def analyze_block(block, stats):
+    tokens, lengths, num_crossing = remove_crossing_tags(*parse_lines(block))
+    stats["crossing"] += int(num_crossing.sum())
+
+    # every metric reads the same matched-bracket index; depth and width are both the largest stack size
+    match, parent, depths = match_brackets(tokens, lengths)
+    leaves = compute_leaf_nodes(match)
+    avgs, variances, stds = compute_branching_factors(parent)
+    symmetries = compute_symmetry_scores(tokens, match)
+
+    for depth, leaf, avg, var, std, symmetry in zip(
+        depths.tolist(), leaves.tolist(), avgs.tolist(), variances.tolist(), stds.tolist(), symmetries.tolist()
+    ):
+        stats["depth"][depth] += 1
+        stats["leaves"][leaf] += 1
+        stats["width"][depth] += 1
+
+        stats["branch_avg"][round(avg, 2)] += 1
+        stats["branch_var"][round(var, 2)] += 1
+        stats["branch_std"][round(std, 2)] += 1
+
+        stats["symmetry"][round(round(symmetry, 4), 2)] += 1
 
-    non_projective_tags = set()
-    all_pairs = []
-    for tag, intervals in tag_intervals.items():
-        for start, end in intervals:
-            all_pairs.append((start, end, tag))
+def byte_ranges(input_file, chunk_bytes):
+    size = os.path.getsize(input_file)
+    return [(start, min(start + chunk_bytes, size)) for start in range(0, size, chunk_bytes)]
 
-    for i in range(len(all_pairs)):
-        s1, e1, tag1 = all_pairs[i]
-        for j in range(i+1, len(all_pairs)):
-            s2, e2, tag2 = all_pairs[j]
-            if (s1 < s2 < e1 < e2) or (s2 < s1 < e2 < e1):
-                non_projective_tags.add(tag1)
-                non_projective_tags.add(tag2)
+def analyze_range(input_file, start, end):
+    """
+    Analyzes the lines that start within bytes [start, end) of the input, so that consecutive ranges cover every
+    line exactly once whatever the range boundaries are.
+    """
+    stats = empty_stats()
+    with open(input_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        # a line starting before `start` belongs to the previous range
+        if start > 0:
+            data.seek(data.find(b"\n", start - 1) + 1 or len(data))
 
-    cleaned = [tag for tag in tags if tag not in non_projective_tags]
-    return ' '.join(cleaned), len(non_projective_tags)
+        def lines():
+            while data.tell() < end:
+                yield data.readline().decode("utf-8")
 
+        for block in read_blocks(lines()):
+            analyze_block(block, stats)
+    return stats
 
-with open(input_file, "r", encoding="utf-8") as f:
-    lines = f.readlines()
+def analyze_ranges(input_file, ranges, num_workers=1):
+    """
+    Yields (index, stats) for every (index, (start, end)) of `ranges` as it completes, in a pool of `num_workers`
+    processes if there is more than one.
+    """
+    if num_workers <= 1:
+        for index, (start, end) in ranges:
+            yield index, analyze_range(input_file, start, end)
+        return
 
-crossing = 0
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(analyze_range, input_file, start, end): index for index, (start, end) in ranges}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
 
-for line in tqdm(lines, desc="Processing lines"):
-    if not line.strip():
-        continue
+def input_identity(input_file, chunk_bytes):
+    # a checkpoint only applies to the same file, unmodified since, split into the same ranges
+    stat = os.stat(input_file)
+    return {
+        "input": os.path.abspath(input_file),
+        "input_size": stat.st_size,
+        "input_mtime_ns": stat.st_mtime_ns,
+        "chunk_bytes": chunk_bytes,
+    }
 
-    data = remove_crossing_tags(line)
+def load_checkpoint(checkpoint_file, input_file, chunk_bytes):
+    # histograms are stored as [key, count] pairs so that integer and float keys survive the round trip
+    if not os.path.exists(checkpoint_file):
+        return set(), empty_stats()
+    with open(checkpoint_file, "r", encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    identity = input_identity(input_file, chunk_bytes)
+    if any(checkpoint.get(key) != value for key, value in identity.items()):
+        tqdm.write(
+            f"Ignoring checkpoint {checkpoint_file}: it was written for a different or modified input, or another "
+            "chunk size",
+            file=sys.stderr,
+        )
+        return set(), empty_stats()
 
-    line = data[0]
+    stats = empty_stats()
+    for name in HISTOGRAMS:
+        stats[name].update(dict(checkpoint["stats"][name]))
+    stats["crossing"] = checkpoint["stats"]["crossing"]
+    return set(checkpoint["completed"]), stats
 
-    if data[1] != '':
-        crossing += int(data[1])
+def save_checkpoint(checkpoint_file, input_file, chunk_bytes, completed, stats):
+    checkpoint = {
+        **input_identity(input_file, chunk_bytes),
+        "completed": sorted(completed),
+        "stats": {name: sorted(stats[name].items()) for name in HISTOGRAMS},
+    }
+    checkpoint["stats"]["crossing"] = stats["crossing"]
+    with open(checkpoint_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(checkpoint_file + ".tmp", checkpoint_file)
 
-    depth = get_nesting_depth(line)
-    leaf = count_leaf_nodes(line)
-    width = compute_width(line)
-    avg, var, std = compute_branching_factors(line)
-    symmetry = compute_symmetry_score(line)
+def main():
+    parser = argparse.ArgumentParser(description="Analyze bracketed structure statistics from a sequence file.")
+    parser.add_argument("--input", "-i", required=True, help="Input file path (sequence format)")
+    parser.add_argument("--output", "-o", required=True, help="Output JSON file path")
+    parser.add_argument("--num-workers", type=int, default=1, help="Number of processes analyzing byte ranges")
+    parser.add_argument("--chunk-bytes", type=int, default=CHUNK_BYTES, help="Size of the byte range of one task")
+    parser.add_argument("--checkpoint", default=None, help="Partial results file (default: <output>.partial)")
+    args = parser.parse_args()
 
-    depth_counter[depth] += 1
-    leaf_counter[leaf] += 1
-    width_counter[width] += 1
+    input_file = args.input
+    output_file = args.output
+    checkpoint_file = args.checkpoint or output_file + ".partial"
 
-    branch_avg_counter[round(avg, 2)] += 1
-    branch_var_counter[round(var, 2)] += 1
-    branch_std_counter[round(std, 2)] += 1
+    # finished ranges are merged into the checkpoint as they come in, so an interrupted run resumes where it stopped
+    ranges = byte_ranges(input_file, args.chunk_bytes)
+    completed, stats = load_checkpoint(checkpoint_file, input_file, args.chunk_bytes)
+    pending = [(index, byte_range) for index, byte_range in enumerate(ranges) if index not in completed]
+    total_bytes = sum(end - start for _, (start, end) in pending)
 
-    symmetry_counter[round(symmetry, 2)] += 1
+    with tqdm(total=total_bytes, desc="Processing lines", unit="B", unit_scale=True) as progress:
+        for index, range_stats in analyze_ranges(input_file, pending, args.num_workers):
+            merge_stats(stats, range_stats)
+            completed.add(index)
+            save_checkpoint(checkpoint_file, input_file, args.chunk_bytes, completed, stats)
+            progress.update(ranges[index][1] - ranges[index][0])
 
-output = {
-    "depth": dict(sorted(depth_counter.items())),
-    "leaves": dict(sorted(leaf_counter.items())),
-    "width": dict(sorted(width_counter.items())),
-    "branching": {
-        "avg": dict(sorted(branch_avg_counter.items())),
-        "var": dict(sorted(branch_var_counter.items())),
-        "std": dict(sorted(branch_std_counter.items()))
-    },
-    "symmetry": dict(sorted(symmetry_counter.items())),
-    "crossing": crossing
-}
+    output = {
+        "depth": dict(sorted(stats["depth"].items())),
+        "leaves": dict(sorted(stats["leaves"].items())),
+        "width": dict(sorted(stats["width"].items())),
+        "branching": {
+            "avg": dict(sorted(stats["branch_avg"].items())),
+            "var": dict(sorted(stats["branch_var"].items())),
+            "std": dict(sorted(stats["branch_std"].items()))
+        },
+        "symmetry": dict(sorted(stats["symmetry"].items())),
+        "crossing": stats["crossing"]
+    }
 
-with open(output_file, "w", encoding="utf-8") as f_out:
-    json.dump(output, f_out, indent=2)
+    with open(output_file, "w", encoding="utf-8") as f_out:
+        json.dump(output, f_out, indent=2)
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
 
+if __name__ == "__main__":
+    main()
@@ -44,6 +44,10 @@ def get_schema() -> Dict[str, Any]:
         "validation_ratio": merge(tfloat, default(0.0005)),
         "num_proc": merge(tinteger, default(64)),
         "eval_num_proc": merge(tinteger, default(4)),
+        "map_style": merge(tboolean, default(False)),
+        "cache_format": merge(tstring, default("parquet")),
+        "shuffle": merge(tstring, nullable, default("block")),
+        "prefetch_depth": merge(tinteger, default(2)),
     }
 
     # Schema for Model
@@ -0,0 +1,99 @@
+from itertools import combinations, groupby
+import numpy as np
+
+# below this many arcs, comparing every pair is cheaper than setting up the sweep
+MIN_SWEEP_ARCS = 48
+
+def find_crossing_arcs(arcs):
+    """
+    Finds the arcs that cross another arc, where (s1, e1) and (s2, e2) cross when s1 < s2 < e1 < e2.
+
+    `arcs` holds (start, end, tag) triples with start < end; arcs may share endpoints, which is not a crossing.
+    Returns the set of tags of the arcs that cross at least one other arc, and the number of crossing pairs.
+    Runs in O(n log n): see `_count_crossed_from_left`, run once on the arcs and once on their mirror image so
+    that both arcs of every crossing pair are found.
+    """
+    if len(arcs) < MIN_SWEEP_ARCS:
+        tags, count = set(), 0
+        for (s1, e1, tag1), (s2, e2, tag2) in combinations(arcs, 2):
+            if (s1 < s2 < e1 < e2) or (s2 < s1 < e2 < e1):
+                tags.update((tag1, tag2))
+                count += 1
+        return tags, count
+    size = max(end for _, end, _ in arcs) + 1
+    from_left = _count_crossed_from_left([(start, end) for start, end, _ in arcs], size)
+    from_right = _count_crossed_from_left([(size - end, size - start) for start, end, _ in arcs], size + 1)
+    tags = {tag for (_, _, tag), left, right in zip(arcs, from_left, from_right) if left or right}
+    return tags, sum(from_left)
+
+def _count_crossed_from_left(spans, size):
+    # sweep the spans by start position, keeping the end positions of the spans started so far in a Fenwick tree:
+    # a span (s, e) is crossed by every earlier-starting span that ends strictly between s and e, i.e. by
+    # (ends recorded up to e - 1) - (ends recorded up to s)
+    tree = [0] * (size + 1)
+    counts = [0] * len(spans)
+    order = sorted(range(len(spans)), key=spans.__getitem__)
+    for _, group in groupby(order, key=lambda k: spans[k][0]):
+        group = list(group)
+        for k in group:
+            start, end = spans[k]
+            count = 0
+            i = end
+            while i > 0:
+                count += tree[i]
+                i &= i - 1
+            i = start + 1
+            while i > 0:
+                count -= tree[i]
+                i &= i - 1
+            counts[k] = count
+        for k in group:
+            i = spans[k][1] + 1
+            while i <= size:
+                tree[i] += 1
+                i += i & -i
+    return counts
+
+def crossing_arc_mask(rows, starts, ends):
+    """
+    Vectorized counterpart of `find_crossing_arcs` for many lines at once: arc i spans (starts[i], ends[i]) in line
+    rows[i], and only arcs of the same line can cross. Returns a boolean array flagging the arcs that cross another.
+
+    An arc is crossed from the right if an arc starting strictly inside it ends after it, and from the left if an arc
+    ending strictly inside it starts before it. Both are range max/min queries over the arcs sorted by start (resp.
+    end), so this runs in O(n log n) with a handful of NumPy passes per level of the sparse table.
+    """
+    if len(rows) == 0:
+        return np.zeros(0, dtype=bool)
+    # (line, position) keys, so one sorted array covers every line
+    width = int(ends.max()) + 1
+    start_keys, end_keys = rows * width + starts, rows * width + ends
+
+    by_start = np.argsort(start_keys, kind="stable")
+    sorted_starts = start_keys[by_start]
+    lo = np.searchsorted(sorted_starts, start_keys, side="right")
+    hi = np.searchsorted(sorted_starts, end_keys, side="left")
+    from_right = _range_reduce(ends[by_start], lo, hi, np.maximum, -1) > ends
+
+    by_end = np.argsort(end_keys, kind="stable")
+    sorted_ends = end_keys[by_end]
+    lo = np.searchsorted(sorted_ends, start_keys, side="right")
+    hi = np.searchsorted(sorted_ends, end_keys, side="left")
+    from_left = _range_reduce(starts[by_end], lo, hi, np.minimum, width) < starts
+
+    return from_right | from_left
+
+def _range_reduce(values, lo, hi, reduce, empty):
+    # reduce(values[lo:hi]) for every query (`empty` where lo >= hi), from a sparse table that is built one level at a
+    # time: at level k, table[i] = reduce(values[i : i + 2 ** k]), and queries of length in [2 ** k, 2 ** (k + 1))
+    # are answered from two overlapping entries before the next level replaces it
+    out = np.full(len(lo), empty, dtype=values.dtype)
+    lengths = hi - lo
+    levels = np.where(lengths > 0, np.frexp(np.maximum(lengths, 1))[1] - 1, -1)
+    table = values
+    for level in range(int(levels.max(initial=-1)) + 1):
+        if level > 0:
+            table = reduce(table[: -(1 << (level - 1))], table[1 << (level - 1) :])
+        queries = np.flatnonzero(levels == level)
+        out[queries] = reduce(table[lo[queries]], table[hi[queries] - (1 << level)])
+    return out
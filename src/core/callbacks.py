@@ -4,6 +4,7 @@ callbacks.py
 Custom Hugging Face Weights and Biases Callback that allows for writing custom metrics, better resuming functionality.
 """
 
+import json
 import logging
 import os
 import time
@@ -21,6 +22,13 @@ from transformers import (
     is_torch_tpu_available,
 )
 from transformers.integrations import WandbCallback
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR, has_length
+
+from src.corpora.indexer import IndexedDataset
+
+
+# Name of the file next to each checkpoint that records where in the training data the run is
+DATA_STATE_NAME = "data_state.json"
 
 
 # Nest Overwatch under root `mistral` logger, inheriting formatting!
@@ -343,6 +351,43 @@ class CustomCheckpointCallback(TrainerCallback):
         self.freq, self.until = zip(*frequencies)
         assert all(i < j for i, j in zip(self.until, self.until[1:])), "Frequency `until_step` not increasing!"
 
+        # The IndexedDataset being trained on (if any), whose position is saved with every checkpoint
+        self.dataset: Optional[IndexedDataset] = None
+        self.epoch_start_step, self.started_epoch = 0, False
+
+    def on_train_begin(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        """Pick up the IndexedDataset being trained on, and where its current epoch started when resuming."""
+        train_dataloader = kwargs.get("train_dataloader")
+        dataset = getattr(train_dataloader, "dataset", None)
+        dataset = getattr(dataset, "_datapipe", dataset)  # Newer torch wraps datapipes in the DataLoader for pickling
+        self.dataset = dataset if isinstance(dataset, IndexedDataset) else None
+        self.epoch_start_step, self.started_epoch = state.global_step, False
+        if self.dataset is None or state.global_step == 0:
+            return
+
+        if args.ignore_data_skip:
+            # The Trainer restored the dataset from its saved data state (if any), so the epoch resumes right there
+            self.epoch_start_step -= self.dataset.num_samples // (
+                self.dataset.batch_size * args.gradient_accumulation_steps
+            )
+        else:
+            # The Trainer replays the batches consumed in the current epoch, counted the same way it does
+            steps_per_epoch = (
+                len(train_dataloader) // args.gradient_accumulation_steps
+                if has_length(train_dataloader)
+                else args.max_steps
+            )
+            steps_per_epoch = max(steps_per_epoch, 1)
+            self.dataset.set_epoch(state.global_step // steps_per_epoch)
+            self.epoch_start_step -= state.global_step % steps_per_epoch
+
+    def on_epoch_begin(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        """Every pass over an IndexedDataset after the first (or the resumed one) starts a new (shuffle) epoch."""
+        if self.dataset is not None and self.started_epoch:
+            self.dataset.set_epoch(self.dataset.epoch + 1)
+            self.epoch_start_step = state.global_step
+        self.started_epoch = True
+
     def on_step_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
         """Borrow Checkpoint Logic from `DefaultFlowCallback` to decide when to checkpoint."""
 
@@ -352,3 +397,16 @@ class CustomCheckpointCallback(TrainerCallback):
             control.should_save = True
 
         return control
+
+
+    def on_save(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        """Write the position in the training data next to the checkpoint (it's the same on every process)."""
+        if self.dataset is not None and state.is_world_process_zero:
+            num_samples = (
+                (state.global_step - self.epoch_start_step)
+                * args.gradient_accumulation_steps
+                * args.per_device_train_batch_size
+            )
+            checkpoint_dir = os.path.join(args.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{state.global_step}")
+            with open(os.path.join(checkpoint_dir, DATA_STATE_NAME), "w") as f:
+                json.dump(self.dataset.state_dict(num_samples, args.per_device_train_batch_size), f)
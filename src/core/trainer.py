@@ -4,10 +4,12 @@ trainer.py
 Custom Hugging Face Trainer that allows for online eval of multiple datasets.
 """
 import collections
+import json
 import logging
+import os
 import time
 from dataclasses import dataclass  # type: ignore
-from typing import Any, Callable, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -31,7 +33,10 @@ from transformers import (
 )
 from transformers.data.data_collator import DataCollator
 from transformers.trainer_callback import TrainerCallback
-from transformers.trainer_utils import EvalPrediction, speed_metrics
+from transformers.trainer_utils import EvalPrediction, get_last_checkpoint, speed_metrics
+
+from src.core.callbacks import DATA_STATE_NAME
+from src.corpora.indexer import IndexedDataset, find_indexed_dataset
 
 
 # Nest Overwatch under root `mistral` logger, inheriting formatting!
@@ -77,6 +82,7 @@ class OnlineBenchmarkTrainer(Trainer):
         )
 
         self.dataset_name = dataset_name
+        self._resume_from_checkpoint: Optional[str] = None
         custom_eval_datasets = custom_eval_datasets if custom_eval_datasets is not None else {}
 
         # No idea why, but you can't use a dict to store the datasets. They must be stored separately as class objects.
@@ -151,9 +157,43 @@ class OnlineBenchmarkTrainer(Trainer):
 
         return output.metrics
 
+    def train(self, resume_from_checkpoint: Optional[Union[str, bool]] = None, *args, **kwargs):
+        """Remembers the checkpoint we resume from, so `get_train_dataloader` can restore the training data position."""
+        if resume_from_checkpoint is True:
+            resume_from_checkpoint = get_last_checkpoint(self.args.output_dir)
+        self._resume_from_checkpoint = resume_from_checkpoint or None
+        return super().train(resume_from_checkpoint, *args, **kwargs)
+
+    def _load_data_state(self, dataset: IndexedDataset, checkpoint: str) -> None:
+        """Restores the position in `dataset` saved with `checkpoint`, so the Trainer doesn't have to skip batches."""
+        data_state_path = os.path.join(checkpoint, DATA_STATE_NAME)
+        if not os.path.isfile(data_state_path):
+            fallback = "restarting the epoch" if self.args.ignore_data_skip else "skipping the consumed batches instead"
+            overwatch.warning(f"No `{DATA_STATE_NAME}` in `{checkpoint}` to resume the training data from, {fallback}")
+            return
+
+        with open(data_state_path, "r") as f:
+            data_state = json.load(f)
+        dataset.load_state_dict(data_state)
+        self.args.ignore_data_skip = True
+        overwatch.info(f"Resuming training data at epoch {data_state['epoch']}, sample {data_state['num_samples']}")
+
     def get_train_dataloader(self) -> DataLoader:
         """ensures we're shuffling if we're using a new-style (iterable) dataset"""
         if isinstance(self.train_dataset, IterDataPipe):
+            # An IndexedDataset source splits its cache across processes itself (and across DataLoader workers), so
+            # each rank only decodes its own share instead of reading everything and dropping the other ranks' samples
+            source = find_indexed_dataset(self.train_dataset)
+            if source is not None:
+                source.shard_across_processes(
+                    self.args.process_index, self.args.world_size, max(1, self.args.dataloader_num_workers)
+                )
+
+            # A bare IndexedDataset is resumed from the data state saved by CustomCheckpointCallback, so the Trainer
+            # must not skip the consumed batches again by replaying them -- unless there is no such state to resume from
+            if source is self.train_dataset and self._resume_from_checkpoint is not None:
+                self._load_data_state(source, self._resume_from_checkpoint)
+
             train_dataset = DataLoader(
                 self.train_dataset,
                 shuffle=True,
@@ -163,7 +203,7 @@ class OnlineBenchmarkTrainer(Trainer):
                 pin_memory=self.args.dataloader_pin_memory,
             )
 
-            if self.args.world_size > 1:
+            if self.args.world_size > 1 and source is None:
                 train_dataset = IterableDatasetShard(
                     train_dataset,
                     batch_size=self.args.train_batch_size,
@@ -182,7 +222,10 @@ class LMDataCollator:
     tokenizer: PreTrainedTokenizerBase
 
     def __call__(self, examples: List[BatchEncoding]):
-        batch = BatchEncoding(data={k: torch.tensor([v[k] for v in examples]) for k in examples[0].keys()})
+        # stack through numpy: examples are usually array views into the token cache, possibly in a narrow dtype
+        batch = BatchEncoding(
+            data={k: torch.tensor(np.array([v[k] for v in examples]), dtype=torch.long) for k in examples[0].keys()}
+        )
 
         if "labels" in batch:
             labels = batch["labels"]
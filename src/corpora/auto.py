@@ -4,25 +4,31 @@ auto.py
 Default Dataset/Corpus Utilities. Downloads (if necessary) from the Hugging Face `datasets` Hub, and organizes into
 de-facto training, validation, and testing tests. Performs additional tokenization and normalization as well.
 """
+import json
 import logging
 import os
 from copy import deepcopy
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Union
 
 import datasets
+import numpy as np
+import pyarrow as pa
 from transformers import BatchEncoding, PreTrainedTokenizer
 
 from src.corpora.detokenization import DATASET_TOKENIZATION_REGISTRY
 
-from .indexer import IndexedDataset
-
-# Nest Overwatch under root `mistral` logger, inheriting formatting!
-from .tokenization_utils import batch_tokenize
+from .indexer import CACHE_FORMAT_REGISTRY, IndexedDataset, MappedIndexedDataset, token_dtype
 
 
+# Nest Overwatch under root `mistral` logger, inheriting formatting!
 overwatch = logging.getLogger("mistral.corpora.auto")
 
+# Written next to the .npy shards by the synthetic corpus generators (synthetic_corpora/corpus_creation_scripts)
+CORPUS_MANIFEST_FILE = "manifest.json"
+# Synthetic corpus split -> Indexed Dataset split
+CORPUS_SPLITS = {"train": "train", "valid": "validation"}
+
 
 def build_indexed_dataset(
     tokenizer: PreTrainedTokenizer,
@@ -35,15 +41,103 @@ def build_indexed_dataset(
     preprocessing_num_proc: int = 64,
     ignore_train: bool = False,
     shuffle_seed: int = 42,
+    train_shuffle: Optional[str] = "block",
     train_shuffle_buffer_size: Optional[int] = 10000,
-) -> Dict[str, IndexedDataset]:
-    """Builds Indexed Datasets from a Dataset Dictionary."""
+    map_style: bool = False,
+    cache_format: str = "parquet",
+    prefetch_depth: int = 2,
+) -> Dict[str, Union[IndexedDataset, MappedIndexedDataset]]:
+    """Builds Indexed Datasets from a Dataset Dictionary.
+
+    If `map_style` is set, the caches are wrapped as random-access MappedIndexedDatasets instead, and shuffling is left
+    to the Trainer's sampler (so the shuffle buffer is not applied); random access needs `cache_format="memmap"` to be
+    fast. `cache_format` selects the on-disk storage backend from CACHE_FORMAT_REGISTRY. `prefetch_depth` row groups
+    are read ahead on a background thread. Only input_ids are cached: the attention_mask is all ones for packed
+    windows, so it's never needed for training.
+
+    `train_shuffle` picks how the training set is shuffled: "block" permutes row groups and windows per epoch (see
+    `IndexedDataset.block_shuffle`), "buffer" uses a `train_shuffle_buffer_size` sample shuffle buffer, None disables
+    shuffling.
+
+    If `dataset_dir` holds a binary corpus from the synthetic generators (a `manifest.json` next to `.npy` shards), its
+    token ids are cached as they are, without going through `datasets` or the tokenizer.
+    """
+    assert cache_format in CACHE_FORMAT_REGISTRY, f"Unknown cache format `{cache_format}`"
+    assert train_shuffle in ["block", "buffer", None], f"Unknown shuffle mode `{train_shuffle}`"
 
     dataset_key = dataset_id
     if dataset_name is not None:
         dataset_key = f"{dataset_name}-{dataset_id}"
 
-    # First, Normalize Text if Necessary. Tokenization Strategies are in detokenization.py.
+    # Create Post-Tokenization Cache Paths
+    tokenization_cache = paths["preprocessed"] / dataset_key / "preprocessing" / "tokenization"
+    tokenization_cache.mkdir(parents=True, exist_ok=True)
+
+    # Every cache format gets its own directory, so switching formats never picks up a stale cache. Parquet caches
+    # written before the ledger had an offset index (in `{k}-tokenized`) can't be read anymore, so theirs is versioned
+    cache_suffix = "-v2" if cache_format == "parquet" else f"-{cache_format}"
+
+    # Corpora written by the synthetic generators are already token ids: their shards are read straight into the cache
+    if dataset_dir is not None and os.path.exists(os.path.join(dataset_dir, CORPUS_MANIFEST_FILE)):
+        overwatch.info(f"Building Indexed Dataset from the binary corpus at {dataset_dir}...")
+        with open(os.path.join(dataset_dir, CORPUS_MANIFEST_FILE), "r") as f:
+            manifest = json.load(f)
+
+        out_datasets = {}
+        for split, k in CORPUS_SPLITS.items():
+            if split not in manifest["splits"] or (ignore_train and k == "train"):
+                continue
+            overwatch.info(f"Building Indexed Dataset for {k}")
+            out_datasets[k] = IndexedDataset.build_or_load(
+                _corpus_batches(dataset_dir, manifest["splits"][split]),
+                tokenization_cache / f"{k}-tokenized{cache_suffix}",
+                seq_len,
+                stride,
+                cache_format=cache_format,
+                dtype=np.dtype(manifest["dtype"]),
+            ).prefetch(prefetch_depth)
+    else:
+        dataset = load_text_dataset(dataset_id, dataset_name, dataset_dir, paths, ignore_train, preprocessing_num_proc)
+        post_tokenization_cache_files = {k: tokenization_cache / f"{k}-tokenized{cache_suffix}" for k in dataset}
+
+        overwatch.info("Building Tokenized Indexed Dataset for {dataset_id}/{dataset_name}...")
+        out_datasets = {}
+        for k, ds in dataset.items():
+            overwatch.info(f"Building Indexed Dataset for {k}")
+            out_datasets[k] = IndexedDataset.build_or_load_from_dataset(
+                ds,
+                tokenizer,
+                post_tokenization_cache_files[k],
+                seq_len,
+                stride,
+                num_proc=preprocessing_num_proc,
+                batch_size=1000,
+                cache_format=cache_format,
+                dtype=token_dtype(len(tokenizer)),
+            ).prefetch(prefetch_depth)
+
+    if map_style:
+        return {k: ds.as_map_style() for k, ds in out_datasets.items()}
+
+    if train_shuffle == "block" and "train" in out_datasets:
+        out_datasets["train"] = out_datasets["train"].block_shuffle(seed=shuffle_seed)
+    elif train_shuffle == "buffer" and train_shuffle_buffer_size is not None and "train" in out_datasets:
+        out_datasets["train"] = out_datasets["train"].seeded_shuffle(
+            seed=shuffle_seed, buffer_size=train_shuffle_buffer_size
+        )
+
+    return out_datasets
+
+
+def load_text_dataset(
+    dataset_id: str,
+    dataset_name: Optional[str],
+    dataset_dir: Optional[str],
+    paths: Dict[str, Path],
+    ignore_train: bool = False,
+    preprocessing_num_proc: int = 64,
+) -> datasets.DatasetDict:
+    """Loads a text dataset from the Hub, or from the train/validation files in `dataset_dir`, and detokenizes it."""
     if dataset_dir is not None:
         file_names = os.listdir(dataset_dir)
         file_type = os.path.splitext(file_names[0])[1][1:]
@@ -68,27 +162,18 @@ def build_indexed_dataset(
     if ignore_train and "train" in dataset:
         del dataset["train"]
 
-    dataset = auto_detokenize(dataset_id, dataset, paths["preprocessed"], preprocessing_num_proc)
+    # Normalize Text if Necessary. Tokenization Strategies are in detokenization.py.
+    return auto_detokenize(dataset_id, dataset, paths["preprocessed"], preprocessing_num_proc)
 
-    # Create Post-Tokenization Cache Paths
-    tokenization_cache = paths["preprocessed"] / dataset_key / "preprocessing" / "tokenization"
-    tokenization_cache.mkdir(parents=True, exist_ok=True)
-
-    post_tokenization_cache_files = {k: tokenization_cache / f"{k}-tokenized" for k in dataset}
 
-    overwatch.info("Building Tokenized Indexed Dataset for {dataset_id}/{dataset_name}...")
-    out_datasets = {}
-    for k, ds in dataset.items():
-        overwatch.info(f"Building Indexed Dataset for {k}")
-        token_iter = batch_tokenize(ds, tokenizer, batch_size=1000)
-        out_datasets[k] = IndexedDataset.build_or_load(token_iter, post_tokenization_cache_files[k], seq_len, stride)  # type: ignore
-
-    if train_shuffle_buffer_size is not None and "train" in out_datasets:
-        out_datasets["train"] = out_datasets["train"].seeded_shuffle(
-            seed=shuffle_seed, buffer_size=train_shuffle_buffer_size
-        )
-
-    return out_datasets
+def _corpus_batches(dataset_dir: str, split: dict, batch_size: int = 1000) -> Iterator[pa.RecordBatch]:
+    """Yields the lines of a binary corpus split as token batches, one line per document."""
+    for shard in split["shards"]:
+        lines = np.load(os.path.join(dataset_dir, shard["file_name"]), mmap_mode="r")
+        for i in range(0, len(lines), batch_size):
+            batch = np.ascontiguousarray(lines[i : i + batch_size])
+            offsets = np.arange(0, batch.size + 1, batch.shape[1], dtype=np.int32)
+            yield pa.RecordBatch.from_arrays([pa.ListArray.from_arrays(offsets, batch.reshape(-1))], ["input_ids"])
 
 
 def get_auto_dataset(
@@ -7,31 +7,58 @@
 # In general, an IndexedDataset is a directory of parquet files plus a metadata file called the ledger.
 # The ledger is a json file with the following structure:
 # {
-#   "files": { "file_name": <name>, "num_tokens": <num_tokens>},
+#   "num_tokens": <total tokens>, "num_docs": <total docs>,
+#   "files": [{ "file_name": <name>, "num_tokens": <num_tokens>, "num_docs": <num_docs>,
+#               "chunk_offsets": [0, <end of row group 0>, <end of row group 1>, ...]}],
 # }
-# We don't actually use the num_tokens field, but it's useful for sanity checking.
+# Every batch handed to the writer becomes one row group, and chunk_offsets holds the cumulative token count at each
+# row group boundary. Together with num_tokens this is enough to find the row group that holds any global token offset
+# without reading data, which is what the map-style MappedIndexedDataset uses for random access, and to count the
+# samples of an IndexedDataset (for a given seq_len and stride) in advance.
 # The ledger is written last, so we can always check to see if we were interrupted.
+# While a cache is being built, each writer (one per shard) keeps a partial ledger, `ledger-{shard}.partial.json`, that
+# is atomically rewritten every time a file is closed: { "num_shards": <num_shards>, "files": [<finished files>] }.
+# If the build is interrupted, the next build resumes each shard after the documents its finished files cover.
+#
+# Parquet is the default storage format, but the cache format is pluggable (see CACHE_FORMAT_REGISTRY). The "memmap"
+# format stores each file as a flat `.bin` of token ids in the narrowest dtype that fits the vocabulary, read back
+# through np.memmap, so slicing is zero-copy and there is no decompression on the training path. Documents aren't
+# delimited on disk: windows span them, and the ledger's chunk_offsets are the only index needed. Ledgers record which
+# format they were written with, and memmap ledgers the token dtype of the `.bin` files as well:
+# { "format": "memmap", "dtype": "uint16", "files": [...] }. Ledgers without a "format" are Parquet.
+#
+# By default only `input_ids` is cached: for packed causal LM training the tokenizer's attention_mask is all ones, so
+# it's synthesized on read when asked for instead. The ledger lists the cached columns: { "columns": ["input_ids"] }.
+# Readers only ever load `input_ids` (Parquet reads are projected), so older caches with masks work the same way.
+import itertools
 import json
 import logging
 import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Iterator, Optional, Union
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar, Union
 
 import datasets
 import numpy as np
 import pyarrow as pa
 import pyarrow.parquet as pq
+from torch.utils.data import get_worker_info
 
 
 try:
     from torchdata.datapipes.iter import IterDataPipe
+    from torchdata.datapipes.map import MapDataPipe
 except ImportError:
-    from torch.utils.data import IterDataPipe
+    from torch.utils.data import IterDataPipe, MapDataPipe
 
 from tqdm import tqdm
-from transformers import AutoTokenizer, BatchEncoding, PreTrainedTokenizerFast
+from transformers import AutoTokenizer, BatchEncoding, PreTrainedTokenizer, PreTrainedTokenizerFast
 
-from src.corpora.tokenization_utils import batch_tokenize, concatenate_and_group_texts
+from src.corpora.tokenization_utils import _mask_overlap, batch_tokenize, group_texts
 
 
 # As a heuristic, we're aiming for files that are around ~250MB
@@ -40,32 +67,430 @@ from src.corpora.tokenization_utils import batch_tokenize, concatenate_and_group
 
 NUM_TOKENS_PER_FILE = 67108864
 
+T = TypeVar("T")
+
 overwatch = logging.getLogger("mistral.corpora.indexer")
 
 # TASKS:
 # TODO: figure out directory structure for caching multiple sources
-# TODO: if we're super careful we can compute the number of samples (for a given batch size and stride) in advance
-#       if we do that, we can implement a Map-style dataset, which is somewhat preferable when not streaming
 # TODO: bring in sprucfluo/simultaneous caching and streaming if we want.
 
 LEDGER_FILE = "ledger.json"
+PARTIAL_LEDGER_TEMPLATE = "ledger-{}.partial.json"
+CACHE_COLUMNS = ("input_ids",)
+# Number of decoded row groups a MappedIndexedDataset keeps for reuse by nearby windows
+CHUNK_CACHE_SIZE = 16
+
+
+class ParquetCacheWriter:
+    def __init__(self, path: Path, schema: pa.Schema):
+        self.paths = [path]
+        self.writer = pq.ParquetWriter(path, schema, version="2.6", compression="ZSTD")
+
+    def write_batch(self, batch: pa.RecordBatch):
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+class MemmapCacheWriter:
+    """Appends the input_ids of each batch to a flat `.bin` file."""
+
+    def __init__(self, path: Path, dtype: np.dtype):
+        self.dtype = np.dtype(dtype)
+        self.paths = [path]
+        self.bin_file = open(path, "wb")
+
+    def write_batch(self, batch: pa.RecordBatch):
+        input_ids = batch.column(batch.schema.get_field_index("input_ids")).flatten().to_numpy(zero_copy_only=False)
+        # casting would silently wrap ids that don't fit, and corrupt the cache
+        info = np.iinfo(self.dtype)
+        if len(input_ids) and (input_ids.min() < info.min or input_ids.max() > info.max):
+            raise ValueError(
+                f"Token ids in [{input_ids.min()}, {input_ids.max()}] don't fit the cache dtype {self.dtype.name}"
+            )
+        self.bin_file.write(input_ids.astype(self.dtype).tobytes())
+
+    def close(self):
+        self.bin_file.close()
+
+
+class ParquetCacheFormat:
+    file_template = "docs-{}.parquet"
+    columns: Optional[Tuple[str, ...]] = None
+
+    @staticmethod
+    def open_writer(path: Path, schema: pa.Schema, dtype: np.dtype) -> ParquetCacheWriter:
+        return ParquetCacheWriter(path, schema)
+
+    @staticmethod
+    def read_chunks(
+        path: str,
+        entry: dict,
+        dtype: np.dtype,
+        chunk_indices: Optional[Sequence[int]] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> Iterator[Dict[str, np.ndarray]]:
+        parquet_file = _open_parquet(path)
+        for chunk_index in range(parquet_file.num_row_groups) if chunk_indices is None else chunk_indices:
+            yield _flatten_columns(parquet_file.read_row_group(chunk_index, columns=columns))
+
+    @staticmethod
+    def read_chunk(
+        path: str, entry: dict, dtype: np.dtype, chunk_index: int, columns: Optional[Sequence[str]] = None
+    ) -> Dict[str, np.ndarray]:
+        return _flatten_columns(_open_parquet(path).read_row_group(chunk_index, columns=columns))
+
+
+class MemmapCacheFormat:
+    file_template = "docs-{}.bin"
+    # the only column that is ever stored, whatever is asked for
+    columns = ("input_ids",)
+
+    @staticmethod
+    def open_writer(path: Path, schema: pa.Schema, dtype: np.dtype) -> MemmapCacheWriter:
+        return MemmapCacheWriter(path, dtype)
+
+    @staticmethod
+    def read_chunks(
+        path: str,
+        entry: dict,
+        dtype: np.dtype,
+        chunk_indices: Optional[Sequence[int]] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> Iterator[Dict[str, np.ndarray]]:
+        # only input_ids is ever stored, so there is nothing to project
+        tokens = _open_memmap(path, np.dtype(dtype).str)
+        offsets = entry["chunk_offsets"]
+        for chunk_index in range(len(offsets) - 1) if chunk_indices is None else chunk_indices:
+            yield {"input_ids": tokens[offsets[chunk_index] : offsets[chunk_index + 1]]}
+
+    @staticmethod
+    def read_chunk(
+        path: str, entry: dict, dtype: np.dtype, chunk_index: int, columns: Optional[Sequence[str]] = None
+    ) -> Dict[str, np.ndarray]:
+        begin, end = entry["chunk_offsets"][chunk_index : chunk_index + 2]
+        return {"input_ids": _open_memmap(path, np.dtype(dtype).str)[begin:end]}
+
+
+# Mapping of cache format name (the Quinfig's `dataset.cache_format`) -> storage backend
+CACHE_FORMAT_REGISTRY = {"parquet": ParquetCacheFormat, "memmap": MemmapCacheFormat}
+
+
+def token_dtype(vocab_size: int) -> np.dtype:
+    """Returns the narrowest unsigned integer dtype that can hold every token id of a vocabulary."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if vocab_size <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+@lru_cache(maxsize=None)
+def _open_memmap(path: str, dtype: str) -> np.ndarray:
+    return np.memmap(path, dtype=np.dtype(dtype), mode="r")
+
+
+@lru_cache(maxsize=None)
+def _open_parquet(path: str) -> pq.ParquetFile:
+    # keeps the file handle and parsed footer around, so reading one row group doesn't reopen the file every time
+    return pq.ParquetFile(path)
+
+
+def find_indexed_dataset(datapipe: IterDataPipe) -> Optional["IndexedDataset"]:
+    """Returns the IndexedDataset at the source of a chain of datapipes (e.g. under a seeded_shuffle), if any."""
+    while not isinstance(datapipe, IndexedDataset) and hasattr(datapipe, "datapipe"):
+        datapipe = datapipe.datapipe
+    return datapipe if isinstance(datapipe, IndexedDataset) else None
+
+
+def _round_robin_consumed(num_samples: List[int], num_batches: int, batch_size: int) -> Tuple[List[int], int]:
+    """DataLoader workers hand out whole batches in turn, skipping the ones that ran out. Given the number of samples of
+    each worker, returns how many of them the first `num_batches` batches took, and which worker is up next."""
+    worker_batches = [-(-n // batch_size) for n in num_samples]
+
+    # Find the number of complete rounds; the next round is cut short after the `remaining` first workers still active
+    lo, hi = 0, max(worker_batches, default=0)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if sum(min(b, mid) for b in worker_batches) <= num_batches:
+            lo = mid
+        else:
+            hi = mid - 1
+    remaining = num_batches - sum(min(b, lo) for b in worker_batches)
+    active = [i for i, b in enumerate(worker_batches) if b > lo]
+
+    taken = [min(b, lo) + (i in active[:remaining]) for i, b in enumerate(worker_batches)]
+    next_worker = active[remaining] if remaining < len(active) else 0
+    return [min(t * batch_size, n) for t, n in zip(taken, num_samples)], next_worker
+
+
+def _prefetch(iterator: Iterator[T], depth: int) -> Iterator[T]:
+    """Runs `iterator` on a background thread, keeping up to `depth` of its items ready ahead of the consumer."""
+    if depth <= 0:
+        yield from iterator
+        return
+
+    items: queue.Queue = queue.Queue(maxsize=depth)
+    done = threading.Event()
+
+    def put(item) -> bool:
+        # Gives up once the consumer went away, rather than blocking on a full queue forever
+        while not done.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        done.set()
+
+
+@lru_cache(maxsize=None)
+def _attention_mask(seq_len: int) -> np.ndarray:
+    # shared by every window, so it must never be written to
+    mask = np.ones(seq_len, dtype=np.int64)
+    mask.flags.writeable = False
+    return mask
+
+
+def _flatten_columns(table: pa.Table) -> Dict[str, np.ndarray]:
+    return {name: table.column(name).combine_chunks().flatten().to_numpy() for name in table.column_names}
+
+
+def _num_windows(num_tokens: int, seq_len: int, stride: int) -> int:
+    """Number of full `seq_len` windows at offsets 0, stride, 2 * stride, ... in a stream of `num_tokens` tokens."""
+    return (num_tokens - seq_len) // stride + 1 if num_tokens >= seq_len else 0
 
 
 class IndexedDataset(IterDataPipe[BatchEncoding]):
-    def __init__(self, cache_dir, seq_len: int, stride: Optional[int] = None):
+    def __init__(self, cache_dir, seq_len: int, stride: Optional[int] = None, return_attention_mask: bool = False):
         self.cache_dir = cache_dir
         self.ledger = self._load_ledger()
         self.seq_len = seq_len
         self.stride = stride
+        self.return_attention_mask = return_attention_mask
+        self.cache_format = CACHE_FORMAT_REGISTRY[self.ledger.get("format", "parquet")]
+        self.dtype = self.ledger.get("dtype")
+
+        # See `shard_across_processes`
+        self.process_index, self.num_processes, self.num_workers = 0, 1, 1
+
+        # See `block_shuffle`
+        self.shuffle_seed: Optional[int] = None
+        self.shuffle_block_size = 8
+        self.epoch = 0
+
+        # See `load_state_dict`
+        self.num_samples, self.batch_size = 0, 1
+
+        # See `prefetch`
+        self.prefetch_depth = 2
+
+    def shard_across_processes(self, process_index: int, num_processes: int, num_workers: int = 1) -> "IndexedDataset":
+        """Makes each of `num_processes` (e.g. DDP ranks) iterate over its own share of the cache, instead of every
+        process reading all of it. Every process yields the same number of samples, so ranks stay in lockstep.
+
+        `num_workers` is the number of DataLoader workers each process splits its share over; it's only needed to make
+        `__len__` exact, as every worker packs its own token stream."""
+        self.process_index, self.num_processes, self.num_workers = process_index, num_processes, num_workers
+        return self
+
+    def block_shuffle(self, seed: int, block_size: int = 8) -> "IndexedDataset":
+        """Shuffles the cache once per epoch without a sample buffer: the order of all row groups is permuted from
+        (seed, epoch), and the windows of every `block_size` consecutive row groups are permuted among each other. Only
+        index arrays are held in memory, and the order is reproducible for a given (seed, epoch)."""
+        self.shuffle_seed, self.shuffle_block_size = seed, block_size
+        return self
+
+    def prefetch(self, depth: int) -> "IndexedDataset":
+        """Reads up to `depth` row groups ahead on a background thread while the current ones are consumed, so that
+        decoding the next file doesn't stall training at file boundaries. A depth of 0 reads synchronously."""
+        self.prefetch_depth = depth
+        return self
+
+    def set_epoch(self, epoch: int) -> None:
+        if epoch != self.epoch:
+            self.epoch, self.num_samples = epoch, 0
+
+    def state_dict(self, num_samples: int, batch_size: int = 1) -> Dict[str, int]:
+        """Returns the position in the data once this process consumed `num_samples` samples of the current epoch, in
+        batches of `batch_size`. The caller has to count them: DataLoader workers iterate over copies of the dataset."""
+        return {"epoch": self.epoch, "num_samples": num_samples, "batch_size": batch_size}
+
+    def load_state_dict(self, state_dict: Dict[str, int]) -> None:
+        """Restores a `state_dict`. The next pass starts right after the consumed samples, without reading them."""
+        self.epoch, self.num_samples, self.batch_size = (
+            state_dict["epoch"],
+            state_dict["num_samples"],
+            state_dict["batch_size"],
+        )
 
     def _files(self):
         for entry in self.ledger["files"]:
             yield entry["file_name"]
 
+    def _chunk_order(self) -> Optional[np.ndarray]:
+        """Permutation of all row groups of the cache for the current epoch, or None to read them in cache order."""
+        if self.shuffle_seed is None:
+            return None
+        num_chunks = sum(len(entry["chunk_offsets"]) - 1 for entry in self.ledger["files"])
+        return np.random.default_rng([self.shuffle_seed, self.epoch]).permutation(num_chunks)
+
+    def _shard_chunks(
+        self, shard_index: int, num_shards: int, order: Optional[np.ndarray] = None
+    ) -> List[Tuple[dict, int]]:
+        """Deals the row groups of the cache (in `order`, if given) out to the shards round-robin. Returns the
+        (ledger entry, chunk index) pairs of a single shard, in reading order."""
+        chunks = [(entry, c) for entry in self.ledger["files"] for c in range(len(entry["chunk_offsets"]) - 1)]
+        if order is not None:
+            chunks = [chunks[i] for i in order]
+        return chunks[shard_index::num_shards]
+
+    def _stream_offsets(self, chunks: List[Tuple[dict, int]]) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the token offset of every chunk boundary in the stream of `chunks`, and the number of full windows
+        that are complete at each of those boundaries."""
+        num_tokens = [entry["chunk_offsets"][c + 1] - entry["chunk_offsets"][c] for entry, c in chunks]
+        offsets = np.concatenate([[0], np.cumsum(num_tokens, dtype=np.int64)])
+        num_windows = np.maximum((offsets - self.seq_len) // (self.stride or self.seq_len) + 1, 0)
+        return offsets, num_windows
+
+    def _read_chunks(self, chunks: List[Tuple[dict, int]]) -> Iterator[Dict[str, np.ndarray]]:
+        # Consecutive chunks of the same file are read in one go
+        for _, run in itertools.groupby(chunks, key=lambda chunk: id(chunk[0])):
+            run = list(run)
+            entry = run[0][0]
+            path = f"{self.cache_dir}/{entry['file_name']}"
+            chunk_indices = [c for _, c in run]
+            yield from self.cache_format.read_chunks(path, entry, self.dtype, chunk_indices, columns=["input_ids"])
+
+    def _packed_windows(
+        self, chunks: Iterator[Dict[str, np.ndarray]], begin: int = 0, overlaps_previous: bool = False
+    ) -> Iterator[Dict[str, np.ndarray]]:
+        """Packs the chunks (starting at token `begin` of the first one) as one token stream, yielding the full windows
+        of each chunk as a single batch. The tokens after the last full window of a chunk are carried over into the
+        next chunk (and across files) instead of being dropped, so only the tail of the stream is lost."""
+        stride = self.stride or self.seq_len
+        carry: Optional[Dict[str, np.ndarray]] = None
+        for chunk in chunks:
+            if carry is None:
+                chunk = {k: v[begin:] for k, v in chunk.items()}
+            else:
+                chunk = {k: np.concatenate([carry[k], v]) for k, v in chunk.items()}
+
+            windows = group_texts(chunk, self.seq_len, stride, overlaps_previous=overlaps_previous)
+            num_windows = len(windows["input_ids"])
+            yield windows
+
+            overlaps_previous = overlaps_previous or num_windows > 0
+            carry = {k: v[num_windows * stride :] for k, v in chunk.items()}
+
+    def _blocks(
+        self, batches: Iterator[Dict[str, np.ndarray]], shard_index: int, first_block: int, skip: int
+    ) -> Iterator[Dict[str, np.ndarray]]:
+        """Yields the windows of every `shuffle_block_size` consecutive batches, in a random order seeded by (seed,
+        epoch, shard, block) when shuffling. The first `skip` windows of the first block are left out."""
+        block_size = self.shuffle_block_size if self.shuffle_seed is not None else 1
+        for block_index in itertools.count(first_block):
+            block = list(itertools.islice(batches, block_size))
+            if not block:
+                return
+
+            offsets = np.cumsum([0] + [len(batch["input_ids"]) for batch in block])
+            if self.shuffle_seed is None:
+                indices = np.arange(offsets[-1])
+            else:
+                rng = np.random.default_rng([self.shuffle_seed, self.epoch, shard_index, block_index])
+                indices = rng.permutation(offsets[-1])
+
+            for i in indices[skip:]:
+                b = np.searchsorted(offsets, i, side="right") - 1
+                yield {k: v[i - offsets[b]] for k, v in block[b].items()}
+            skip = 0
+
+    def _shards(self, num_workers: int) -> Tuple[List[List[Tuple[dict, int]]], list, List[int]]:
+        """Splits the cache (in the current epoch's order) into a shard per (process, DataLoader worker) pair. Returns
+        the chunks of every shard, their stream offsets (see `_stream_offsets`) and the number of windows each yields.
+        Only the ledger is read."""
+        num_shards = self.num_processes * num_workers
+        order = self._chunk_order()
+        shard_chunks = [self._shard_chunks(i, num_shards, order) for i in range(num_shards)]
+        shard_offsets = [self._stream_offsets(chunks) for chunks in shard_chunks]
+        shard_num_windows = [int(num_windows[-1]) for _, num_windows in shard_offsets]
+
+        # With several processes, stop every shard at the smallest shard's length so all processes stay in step
+        if self.num_processes > 1:
+            shard_num_windows = [min(shard_num_windows)] * num_shards
+
+        return shard_chunks, shard_offsets, shard_num_windows
+
+    def __len__(self) -> int:
+        """Number of samples this process yields per epoch, over all of its DataLoader workers."""
+        _, _, shard_num_windows = self._shards(self.num_workers)
+        first_shard = self.process_index * self.num_workers
+        return sum(shard_num_windows[first_shard : first_shard + self.num_workers])
+
     def __iter__(self):
-        for file_name in self._files():
-            for entry in read_cache_file(f"{self.cache_dir}/{file_name}", flatten=True):
-                yield from concatenate_and_group_texts(entry, self.seq_len, self.stride)
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        # Every (process, worker) pair reads its own shard of the cache
+        shard_chunks, shard_offsets, shard_num_windows = self._shards(num_workers)
+
+        # When resuming, work out what each worker's shard already handed out. Workers swap shards so that the first
+        # worker the DataLoader asks for a batch is the one whose shard was up next.
+        first_shard = self.process_index * num_workers
+        consumed, next_worker = _round_robin_consumed(
+            shard_num_windows[first_shard : first_shard + num_workers],
+            self.num_samples // self.batch_size,
+            self.batch_size,
+        )
+        worker_shard = (worker_id + next_worker) % num_workers
+        shard_index, skip = first_shard + worker_shard, consumed[worker_shard]
+        chunks, (offsets, num_windows) = shard_chunks[shard_index], shard_offsets[shard_index]
+
+        # Resume at the block holding the first unconsumed window. Reading starts at the chunk holding the first token
+        # of that block's first window; the chunks before the block itself only contribute carried-over tokens.
+        block_size = self.shuffle_block_size if self.shuffle_seed is not None else 1
+        first_block = int(np.searchsorted(num_windows[::block_size], skip, side="right")) - 1
+        first_chunk = first_block * block_size
+        first_window = int(num_windows[first_chunk])
+        begin = first_window * (self.stride or self.seq_len)
+        read_from = min(int(np.searchsorted(offsets, begin, side="right")) - 1, first_chunk)
+
+        batches = self._packed_windows(
+            _prefetch(self._read_chunks(chunks[read_from:]), self.prefetch_depth),
+            begin - int(offsets[read_from]),
+            overlaps_previous=first_window > 0,
+        )
+        batches = itertools.islice(batches, first_chunk - read_from, None)
+        windows = self._blocks(batches, shard_index, first_block, skip - first_window)
+
+        attention_mask = _attention_mask(self.seq_len) if self.return_attention_mask else None
+        for window in itertools.islice(windows, max(0, shard_num_windows[shard_index] - skip)):
+            if attention_mask is not None:
+                window["attention_mask"] = attention_mask
+            yield BatchEncoding(window)
 
     @staticmethod
     def build_or_load(
@@ -74,82 +499,411 @@ class IndexedDataset(IterDataPipe[BatchEncoding]):
         seq_len: int,
         stride: Optional[int] = None,
         num_tokens_per_file: int = NUM_TOKENS_PER_FILE,
-        file_template: str = "docs-{}.parquet",
+        file_template: Optional[str] = None,
+        cache_format: str = "parquet",
+        dtype: Optional[np.dtype] = None,
+        columns: Sequence[str] = CACHE_COLUMNS,
     ) -> "IndexedDataset":
+        """Writes `token_iter` to `cache_dir` in the given cache format, unless a complete cache already exists there.
+
+        `dtype` is the on-disk token dtype for formats that store raw arrays (see `token_dtype`); it defaults to int32.
+        Only the tokenizer outputs in `columns` are stored.
+        """
+        dtype = np.dtype(dtype or np.int32)
         os.makedirs(cache_dir, exist_ok=True)
-        ledger_file = os.path.join(cache_dir, LEDGER_FILE)
 
-        if os.path.exists(ledger_file):
+        if os.path.exists(os.path.join(cache_dir, LEDGER_FILE)):
             overwatch.info("Found existing indexed dataset at %s", cache_dir)
             return IndexedDataset(cache_dir, seq_len, stride)
 
-        file_index = 0
-        current_writer: Optional[pq.ParquetWriter] = None
-        current_num_tokens = 0
-        tq: tqdm = tqdm(desc=f"file {file_index} progress", total=num_tokens_per_file, unit="token")
-        file_out: Optional[str] = None
+        file_template = file_template or CACHE_FORMAT_REGISTRY[cache_format].file_template
+        finished_files = _load_partial_ledger(cache_dir, 0)["files"]
+        ledger_files = _write_cache_files(
+            _skip_docs(token_iter, sum(entry["num_docs"] for entry in finished_files)),
+            cache_dir,
+            file_template,
+            num_tokens_per_file,
+            cache_format,
+            dtype,
+            shard_index=0,
+            num_shards=1,
+            finished_files=finished_files,
+            columns=columns,
+        )
+
+        # if we successfully wrote the whole iterator, we can write the ledger
+        _write_ledger(cache_dir, _make_ledger(cache_format, dtype, columns, ledger_files), num_shards=1)
+        return IndexedDataset(cache_dir, seq_len, stride)
 
-        # list of (file_name, num_tokens), to be output at the end if we finish the whole iterator
-        ledger_files = []
+    @staticmethod
+    def build_or_load_from_dataset(
+        dataset: datasets.Dataset,
+        tokenizer: PreTrainedTokenizer,
+        cache_dir: Union[str, os.PathLike],
+        seq_len: int,
+        stride: Optional[int] = None,
+        num_proc: int = 1,
+        batch_size: int = 1000,
+        num_tokens_per_file: int = NUM_TOKENS_PER_FILE,
+        cache_format: str = "parquet",
+        dtype: Optional[np.dtype] = None,
+        columns: Sequence[str] = CACHE_COLUMNS,
+    ) -> "IndexedDataset":
+        """Tokenizes `dataset` and writes it to `cache_dir`, unless a complete cache already exists there.
+
+        The dataset is split into `num_proc` contiguous shards that are tokenized and written by separate processes.
+        Shard i writes files `docs-{i}-{j}`, and the merged ledger lists the shards in order, so the cache holds the
+        same token stream no matter how many processes built it. An interrupted build is resumed with the sharding it
+        was started with, and each shard skips the documents that its finished files already cover.
+        """
+        dtype = np.dtype(dtype or np.int32)
+        os.makedirs(cache_dir, exist_ok=True)
 
-        def close_writer():
-            nonlocal current_writer, file_out, file_index, current_num_tokens
-            if current_writer is not None:
-                current_writer.close()
-                current_writer = None
+        if os.path.exists(os.path.join(cache_dir, LEDGER_FILE)):
+            overwatch.info("Found existing indexed dataset at %s", cache_dir)
+            return IndexedDataset(cache_dir, seq_len, stride)
 
-            if current_num_tokens > 0:
-                ledger_files.append({"file_name": str(file_out), "num_tokens": current_num_tokens})
+        # Don't bother forking for shards smaller than a single tokenization batch
+        num_shards = _load_partial_ledger(cache_dir, 0).get("num_shards") or max(
+            1, min(num_proc, len(dataset) // batch_size)
+        )
+        shard_args = [
+            (
+                dataset,
+                tokenizer,
+                cache_dir,
+                i,
+                num_shards,
+                batch_size,
+                num_tokens_per_file,
+                cache_format,
+                dtype,
+                columns,
+            )
+            for i in range(num_shards)
+        ]
+        if num_shards == 1:
+            shard_files = [_build_cache_shard(*shard_args[0])]
+        else:
+            overwatch.info(f"Building cache at {cache_dir} with {num_shards} processes")
+            with ProcessPoolExecutor(max_workers=num_shards) as executor:
+                shard_files = list(executor.map(_build_cache_shard, *zip(*shard_args)))
 
-        try:
-            for tokens in token_iter:
-                batch = _as_record_batch(tokens)
-                batch_len = sum(len(t) for t in tokens["input_ids"])
+        ledger_files = [entry for files in shard_files for entry in files]
+        _write_ledger(cache_dir, _make_ledger(cache_format, dtype, columns, ledger_files), num_shards=num_shards)
+        return IndexedDataset(cache_dir, seq_len, stride)
 
-                if current_writer and current_num_tokens + batch_len > num_tokens_per_file:
-                    close_writer()
+    def _load_ledger(self):
+        return _load_ledger(self.cache_dir)
 
-                if not current_writer:
-                    file_out = file_template.format(file_index)
-                    path = Path(f"{cache_dir}/{file_out}")
-                    path.parent.mkdir(parents=True, exist_ok=True)
-                    file_index += 1
+    def as_map_style(self) -> "MappedIndexedDataset":
+        return MappedIndexedDataset(self.cache_dir, self.seq_len, self.stride, self.return_attention_mask)
 
-                    current_writer = pq.ParquetWriter(path, batch.schema, version="2.6", compression="ZSTD")
 
-                    current_num_tokens = 0
+class MappedIndexedDataset(MapDataPipe[BatchEncoding]):
+    """Map-style view of an IndexedDataset cache. All documents are treated as one concatenated token stream, and item i
+    is the `seq_len` window starting at token `i * stride`. Windows are located through the ledger's offset index, so
+    only the row groups that overlap a window are ever read.
 
-                    tq.reset()
-                    tq.set_description(f"file {file_index} progress")
+    The memmap format slices windows straight out of the mapped files. Parquet has to decode a whole row group per
+    read, so the last `chunk_cache_size` decoded row groups are kept around; random access over a large Parquet cache
+    still mostly misses, so use the memmap format for map-style training."""
 
-                current_writer.write_batch(batch)
-                current_num_tokens += batch_len
-                tq.update(batch_len)
+    def __init__(
+        self,
+        cache_dir,
+        seq_len: int,
+        stride: Optional[int] = None,
+        return_attention_mask: bool = False,
+        chunk_cache_size: int = CHUNK_CACHE_SIZE,
+    ):
+        self.cache_dir = cache_dir
+        self.seq_len = seq_len
+        self.stride = stride or seq_len
+        self.return_attention_mask = return_attention_mask
+        self.ledger = _load_ledger(cache_dir)
+        self.cache_format = CACHE_FORMAT_REGISTRY[self.ledger.get("format", "parquet")]
+        self.dtype = self.ledger.get("dtype")
+        if self.cache_format is ParquetCacheFormat:
+            overwatch.warning(
+                f"Random access into the Parquet cache at {cache_dir} decodes a whole row group per window, build it "
+                "with cache_format=memmap for map-style training"
+            )
+
+        files = self.ledger["files"]
+        self.files = files
+        self.chunk_offsets = [np.asarray(entry["chunk_offsets"], dtype=np.int64) for entry in files]
+        self.file_offsets = np.cumsum([0] + [entry["num_tokens"] for entry in files], dtype=np.int64)
+
+        # (file index, row group index) -> decoded columns of the `chunk_cache_size` most recently used row groups
+        self.chunk_cache_size = chunk_cache_size
+        self._chunk_cache: "OrderedDict[tuple, Dict[str, np.ndarray]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return _num_windows(int(self.file_offsets[-1]), self.seq_len, self.stride)
+
+    def __getitem__(self, index: int) -> BatchEncoding:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"index {index} out of range for dataset of length {len(self)}")
+
+        begin = index * self.stride
+        # upcast here, so narrow on-disk dtypes never leak into labels (which need -100) or torch
+        data = {k: v.astype(np.int64) for k, v in self._read_tokens(begin, begin + self.seq_len).items()}
+
+        if self.stride != self.seq_len:
+            labels = data.get("labels", data["input_ids"])
+            if begin != 0:
+                labels = _mask_overlap(labels, self.seq_len, self.stride)
+            data["labels"] = labels
+
+        if self.return_attention_mask:
+            data["attention_mask"] = _attention_mask(self.seq_len)
+
+        return BatchEncoding(data=data)
+
+    def _read_tokens(self, begin: int, end: int) -> Dict[str, np.ndarray]:
+        """Reads global token positions [begin, end) from the cache, crossing row group and file boundaries."""
+        pieces: Dict[str, list] = {}
+        pos = begin
+        while pos < end:
+            file_index = int(np.searchsorted(self.file_offsets, pos, side="right")) - 1
+            file_pos = pos - int(self.file_offsets[file_index])
+            offsets = self.chunk_offsets[file_index]
+            chunk_index = int(np.searchsorted(offsets, file_pos, side="right")) - 1
+
+            chunk = self._read_chunk(file_index, chunk_index)
+            chunk_begin = file_pos - int(offsets[chunk_index])
+            chunk_end = min(int(offsets[chunk_index + 1]), file_pos + end - pos) - int(offsets[chunk_index])
+            for k, v in chunk.items():
+                pieces.setdefault(k, []).append(v[chunk_begin:chunk_end])
+            pos += chunk_end - chunk_begin
+
+        return {k: v[0] if len(v) == 1 else np.concatenate(v) for k, v in pieces.items()}
+
+    def _read_chunk(self, file_index: int, chunk_index: int) -> Dict[str, np.ndarray]:
+        key = (file_index, chunk_index)
+        if key in self._chunk_cache:
+            self._chunk_cache.move_to_end(key)
+            return self._chunk_cache[key]
+
+        entry = self.files[file_index]
+        path = f"{self.cache_dir}/{entry['file_name']}"
+        chunk = self.cache_format.read_chunk(path, entry, self.dtype, chunk_index, columns=["input_ids"])
+        self._chunk_cache[key] = chunk
+        if len(self._chunk_cache) > self.chunk_cache_size:
+            self._chunk_cache.popitem(last=False)
+        return chunk
+
+
+def _build_cache_shard(
+    dataset: datasets.Dataset,
+    tokenizer: PreTrainedTokenizer,
+    cache_dir: Union[str, os.PathLike],
+    shard_index: int,
+    num_shards: int,
+    batch_size: int,
+    num_tokens_per_file: int,
+    cache_format: str,
+    dtype: np.dtype,
+    columns: Sequence[str] = CACHE_COLUMNS,
+) -> List[dict]:
+    """Tokenizes and writes one contiguous shard of `dataset`, returning the ledger entries of the files written."""
+    shard = dataset.shard(num_shards=num_shards, index=shard_index, contiguous=True)
+    file_template = CACHE_FORMAT_REGISTRY[cache_format].file_template.format(f"{shard_index}-{{}}")
+
+    # Skip the docs covered by files a previous (interrupted) build already finished, before we spend time tokenizing
+    finished_files = _load_partial_ledger(cache_dir, shard_index)["files"]
+    num_finished_docs = sum(entry["num_docs"] for entry in finished_files)
+    if num_finished_docs > 0:
+        overwatch.info(f"Resuming shard {shard_index} of {cache_dir} after {num_finished_docs} docs")
+        shard = shard.select(range(num_finished_docs, len(shard)))
+
+    return _write_cache_files(
+        batch_tokenize(shard, tokenizer, batch_size=batch_size, return_attention_mask="attention_mask" in columns),
+        cache_dir,
+        file_template,
+        num_tokens_per_file,
+        cache_format,
+        dtype,
+        shard_index=shard_index,
+        num_shards=num_shards,
+        finished_files=finished_files,
+        show_progress=shard_index == 0,
+        columns=columns,
+    )
+
+
+def _write_cache_files(
+    token_iter: Iterator[Union[BatchEncoding, pa.RecordBatch]],
+    cache_dir: Union[str, os.PathLike],
+    file_template: str,
+    num_tokens_per_file: int,
+    cache_format: str,
+    dtype: np.dtype,
+    shard_index: int,
+    num_shards: int,
+    finished_files: Optional[List[dict]] = None,
+    show_progress: bool = True,
+    columns: Sequence[str] = CACHE_COLUMNS,
+) -> List[dict]:
+    """Writes `token_iter` out as a sequence of cache files, rolling over to a new file every `num_tokens_per_file`
+    tokens. Returns the ledger entries (see top of file) of the files written.
+
+    The shard's partial ledger is rewritten each time a file is finished. When resuming, `finished_files` are the
+    entries of a previous build, and `token_iter` must start right after the docs they cover. Only the tokenizer
+    outputs in `columns` are written.
+    """
+    fmt = CACHE_FORMAT_REGISTRY[cache_format]
+    # list of ledger entries (see top of file) for the files we've finished
+    ledger_files = list(finished_files or [])
+    _write_partial_ledger(cache_dir, shard_index, num_shards, ledger_files)
+
+    file_index = len(ledger_files)
+    current_writer: Optional[Union[ParquetCacheWriter, MemmapCacheWriter]] = None
+    current_num_tokens = 0
+    tq: tqdm = tqdm(
+        desc=f"file {file_index} progress", total=num_tokens_per_file, unit="token", disable=not show_progress
+    )
+    file_out: Optional[str] = None
+    current_num_docs = 0
+    current_chunk_offsets = [0]
+
+    def close_writer():
+        nonlocal current_writer, file_out, file_index, current_num_tokens
+        if current_writer is not None:
+            current_writer.close()
+            current_writer = None
+
+        if current_num_tokens > 0:
+            ledger_files.append(
+                {
+                    "file_name": str(file_out),
+                    "num_tokens": current_num_tokens,
+                    "num_docs": current_num_docs,
+                    "chunk_offsets": current_chunk_offsets,
+                }
+            )
+            _write_partial_ledger(cache_dir, shard_index, num_shards, ledger_files)
 
-            if current_writer:
-                tq.reset(current_num_tokens)
-                tq.update(current_num_tokens)
+    try:
+        for tokens in token_iter:
+            batch = _as_record_batch(tokens, columns)
+            batch_len = len(batch.column(batch.schema.get_field_index("input_ids")).flatten())
+
+            # (never roll over from a file without tokens: unrecorded docs would throw off resuming)
+            if current_writer and 0 < current_num_tokens and current_num_tokens + batch_len > num_tokens_per_file:
                 close_writer()
 
-            # if we successfully wrote the whole iterator, we can write the ledger
-            with open(ledger_file, "w") as f:
-                ledger = {"files": ledger_files}
-                json.dump(ledger, f)
+            if not current_writer:
+                file_out = file_template.format(file_index)
+                path = Path(f"{cache_dir}/{file_out}")
+                path.parent.mkdir(parents=True, exist_ok=True)
+                file_index += 1
 
-            return IndexedDataset(cache_dir, seq_len, stride)
-        except (KeyboardInterrupt, InterruptedError):
+                current_writer = fmt.open_writer(path, batch.schema, dtype)
+
+                current_num_tokens = 0
+                current_num_docs = 0
+                current_chunk_offsets = [0]
+
+                tq.reset()
+                tq.set_description(f"file {file_index} progress")
+
+            current_writer.write_batch(batch)
+            current_num_tokens += batch_len
+            current_num_docs += batch.num_rows
+            current_chunk_offsets.append(current_num_tokens)
+            tq.update(batch_len)
+
+        if current_writer:
+            tq.reset(current_num_tokens)
+            tq.update(current_num_tokens)
+            close_writer()
+
+        return ledger_files
+    except (KeyboardInterrupt, InterruptedError):
+        # Only the file in progress is lost, finished files are already in the partial ledger
+        if current_writer is not None:
             current_writer.close()
+            for path in current_writer.paths:
+                path.unlink(missing_ok=True)
             current_writer = None
-            file_out.unlink(missing_ok=True)  # type: ignore
-            raise
+        raise
 
-    def _load_ledger(self):
-        ledger_path = os.path.join(self.cache_dir, LEDGER_FILE)
-        if os.path.exists(ledger_path):
-            with open(ledger_path, "r") as f:
-                return json.load(f)
-        else:
-            raise FileNotFoundError(f"{self.cache_dir} is not a complete cache")
+
+def _skip_docs(
+    token_iter: Iterator[Union[BatchEncoding, pa.RecordBatch]], num_docs: int
+) -> Iterator[Union[BatchEncoding, pa.RecordBatch]]:
+    """Skips the first `num_docs` docs of `token_iter`. Files always end on a batch boundary, so when resuming from a
+    partial ledger this drops whole batches."""
+    for tokens in token_iter:
+        if num_docs <= 0:
+            yield tokens
+            continue
+
+        num_docs -= tokens.num_rows if isinstance(tokens, pa.RecordBatch) else len(tokens["input_ids"])
+        if num_docs < 0:
+            raise ValueError("Batches don't line up with the partial ledger, delete the cache to rebuild it")
+
+
+def _write_json_atomic(path: Union[str, os.PathLike], obj: dict):
+    """Writes `obj` to a temporary file and renames it over `path`, so readers never see a partial file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _write_partial_ledger(cache_dir: Union[str, os.PathLike], shard_index: int, num_shards: int, files: List[dict]):
+    path = os.path.join(cache_dir, PARTIAL_LEDGER_TEMPLATE.format(shard_index))
+    _write_json_atomic(path, {"num_shards": num_shards, "files": files})
+
+
+def _load_partial_ledger(cache_dir: Union[str, os.PathLike], shard_index: int) -> dict:
+    path = os.path.join(cache_dir, PARTIAL_LEDGER_TEMPLATE.format(shard_index))
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return {"num_shards": None, "files": []}
+
+
+def _make_ledger(cache_format: str, dtype: np.dtype, columns: Sequence[str], files: List[dict]) -> dict:
+    ledger = {
+        "format": cache_format,
+        "columns": list(CACHE_FORMAT_REGISTRY[cache_format].columns or columns),
+        "num_tokens": sum(entry["num_tokens"] for entry in files),
+        "num_docs": sum(entry["num_docs"] for entry in files),
+        "files": files,
+    }
+    # only raw array formats are written in `dtype`, Parquet keeps the tokenizer's column types
+    if cache_format == "memmap":
+        ledger["dtype"] = dtype.name
+    return ledger
+
+
+def _write_ledger(cache_dir: Union[str, os.PathLike], ledger: dict, num_shards: int):
+    _write_json_atomic(os.path.join(cache_dir, LEDGER_FILE), ledger)
+
+    # the complete ledger supersedes the partial ones
+    for shard_index in range(num_shards):
+        Path(cache_dir, PARTIAL_LEDGER_TEMPLATE.format(shard_index)).unlink(missing_ok=True)
+
+
+def _load_ledger(cache_dir):
+    ledger_path = os.path.join(cache_dir, LEDGER_FILE)
+    if os.path.exists(ledger_path):
+        with open(ledger_path, "r") as f:
+            ledger = json.load(f)
+    else:
+        raise FileNotFoundError(f"{cache_dir} is not a complete cache")
+
+    if any("chunk_offsets" not in entry for entry in ledger["files"]):
+        raise ValueError(f"{cache_dir} was built without an offset index, delete it to rebuild the cache")
+    return ledger
 
 
 def read_cache_file(file, flatten: bool = False) -> Iterator[BatchEncoding]:
@@ -172,9 +926,16 @@ def read_cache_file(file, flatten: bool = False) -> Iterator[BatchEncoding]:
             )
 
 
-def _as_record_batch(doc: BatchEncoding) -> pa.RecordBatch:
-    names, columns = zip(*[(k, pa.array(v)) for k, v in doc.items()])
-    return pa.RecordBatch.from_arrays(list(columns), names)
+def _as_record_batch(
+    doc: Union[BatchEncoding, pa.RecordBatch], columns: Optional[Sequence[str]] = None
+) -> pa.RecordBatch:
+    """Converts a tokenized batch to the record batch the cache writers take, keeping only `columns` (default all)."""
+    if isinstance(doc, pa.RecordBatch):
+        names = list(columns or doc.schema.names)
+        return pa.RecordBatch.from_arrays([doc.column(doc.schema.get_field_index(k)) for k in names], names)
+
+    names = list(columns or doc.keys())
+    return pa.RecordBatch.from_arrays([pa.array(doc[k]) for k in names], names)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,14 @@
 import copy
 import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from itertools import chain
-from typing import Iterable, Iterator, List, Optional, Sized, Tuple, TypeVar
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Sized, Tuple, TypeVar, Union
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 from datasets import Dataset
 
 
@@ -32,54 +38,113 @@ def batched(iterable: Iterable[T], batch_size: int) -> Iterable[List[T]]:
         yield batch
 
 
-def batch_tokenize(ds: Dataset, tokenizer, batch_size: int, text_column="text") -> Iterator[BatchEncoding]:
-    """Yields batches of tokenized sentences from the given dataset."""
-    for batch in batched(ds[text_column], batch_size):
-        yield tokenizer(batch)
-
-
-def concatenate_and_group_texts(
-    encoding: BatchEncoding,
+def batch_tokenize(
+    ds: Dataset,
+    tokenizer,
+    batch_size: int,
+    text_column="text",
+    num_threads: int = 4,
+    return_attention_mask: bool = True,
+) -> Iterator[Union[BatchEncoding, pa.RecordBatch]]:
+    """Yields batches of tokenized sentences from the given dataset, streaming it in zero-copy Arrow slices.
+
+    Fast tokenizers encode `num_threads` batches at once on a thread pool (the Rust `encode_batch` releases the GIL),
+    and their batches come out as Arrow record batches that go straight into the cache writer. Pretokenized integer
+    corpora (a PassthroughTokenizer) skip tokenization altogether: the ids are parsed with Arrow compute kernels. Other
+    tokenizers (or fast ones configured to truncate or pad) are called on one batch at a time and yield BatchEncodings.
+    """
+    arrow_ds = ds.with_format("arrow")
+    texts = (arrow_ds[i : i + batch_size].column(text_column) for i in range(0, len(ds), batch_size))
+
+    backend = getattr(tokenizer, "backend_tokenizer", None) if getattr(tokenizer, "is_fast", False) else None
+    if isinstance(tokenizer, PassthroughTokenizer):
+        encode = partial(_parse_integer_text, return_attention_mask=return_attention_mask)
+    elif backend is not None and backend.truncation is None and backend.padding is None:
+        encode = partial(_encode_arrow, backend, return_attention_mask=return_attention_mask)
+    else:
+        for batch in texts:
+            yield tokenizer(batch.to_pylist())
+        return
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending: deque = deque()
+        for batch in texts:
+            pending.append(executor.submit(encode, batch))
+            if len(pending) > num_threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _encode_arrow(backend, texts: pa.ChunkedArray, return_attention_mask: bool) -> pa.RecordBatch:
+    """Encodes a column of texts with a `tokenizers.Tokenizer`, building the list arrays from flat buffers."""
+    encodings = backend.encode_batch(texts.to_pylist())
+    offsets = np.zeros(len(encodings) + 1, dtype=np.int32)
+    np.cumsum([len(encoding) for encoding in encodings], out=offsets[1:])
+    input_ids = np.fromiter(chain.from_iterable(e.ids for e in encodings), dtype=np.int32, count=offsets[-1])
+    return _token_record_batch(offsets, input_ids, return_attention_mask)
+
+
+def _parse_integer_text(texts: pa.ChunkedArray, return_attention_mask: bool) -> pa.RecordBatch:
+    """Parses whitespace-separated token ids, as written by the synthetic corpus scripts, without a tokenizer."""
+    # (empty lines become nulls, as splitting "" would give one empty token)
+    texts = pc.utf8_trim_whitespace(texts.combine_chunks())
+    texts = pc.if_else(pc.greater(pc.utf8_length(texts), 0), texts, pa.scalar(None, texts.type))
+    tokens = pc.utf8_split_whitespace(texts)
+    offsets = np.asarray(tokens.offsets, dtype=np.int32)
+    input_ids = np.asarray(pc.cast(tokens.flatten(), pa.int32()))
+    return _token_record_batch(offsets - offsets[0], input_ids, return_attention_mask)
+
+
+def _token_record_batch(offsets: np.ndarray, input_ids: np.ndarray, return_attention_mask: bool) -> pa.RecordBatch:
+    columns = {"input_ids": pa.ListArray.from_arrays(offsets, input_ids)}
+    if return_attention_mask:
+        columns["attention_mask"] = pa.ListArray.from_arrays(offsets, np.ones(len(input_ids), dtype=np.int8))
+    return pa.RecordBatch.from_arrays(list(columns.values()), list(columns.keys()))
+
+
+def group_texts(
+    tokens: Mapping[str, np.ndarray],
     seq_len: int,
     stride: Optional[int] = None,
-    drop_remainder: bool = True,
-    mask_stride_overlap=True,
-) -> Iterator[BatchEncoding]:
-    """Groups texts in a batch together. Typically, you'll want to use this with a fairly large
-    set of texts, e.g. 1000 docs.
+    mask_stride_overlap: bool = True,
+    overlaps_previous: bool = False,
+) -> Dict[str, np.ndarray]:
+    """Groups a stream of concatenated tokens into windows, e.g. the row groups IndexedDataset reads from its cache.
 
-    You should set mask_stride_overlap to True and drop_remainder to False if you want to use this for test data
+    All full `seq_len` windows are returned at once as a [num_windows, seq_len] array per key. The windows are strided
+    views into `tokens`, so nothing is copied except the labels when we have to mask stride overlaps. The remainder
+    that doesn't fill a whole window is dropped.
 
     Args:
-        encoding: The batch of texts to concatenate and group.
-        seq_len: The max length of sequences to emit
-        stride: The stride to use when grouping texts. If None, then the stride is set to seq_len.
-        mask_stride_overlap: Whether to mask out overlapping tokens if we're using a stride.
-        drop_remainder: Whether to drop the last batch if it's not a multiple of the seq_len.
+        tokens: 1-D arrays of concatenated tokens, keyed by field (input_ids, attention_mask, ...).
+        seq_len: The length of the windows to emit
+        stride: The offset between consecutive windows. If None, then the stride is set to seq_len.
+        mask_stride_overlap: Whether to mask out overlapping tokens in the labels if we're using a stride.
+        overlaps_previous: Whether `tokens` continues a stream that already emitted windows, in which case the first
+            window overlaps the last one emitted and is masked as well.
 
     Returns:
-        An iterator of tokenized texts, one at a time.
+        A dict of [num_windows, seq_len] arrays.
     """
-    concatenated = BatchEncoding(data={k: list(chain(*v)) for k, v in encoding.items()})
-    total_length = len(concatenated.input_ids)
     stride = stride or seq_len
+    total_length = len(tokens["input_ids"])
+    num_windows = (total_length - seq_len) // stride + 1 if total_length >= seq_len else 0
+
+    data = {k: _strided_windows(np.asarray(v), seq_len, stride, num_windows) for k, v in tokens.items()}
 
-    # Drop the "very last" bit of the dataset that doesn't fit into block size...
-    if drop_remainder and total_length % stride != 0:
-        total_length = ((total_length - seq_len + stride) // stride) * stride
+    if mask_stride_overlap and stride != seq_len:
+        labels = data.get("labels", data["input_ids"]).astype(np.int64)
+        labels[0 if overlaps_previous else 1 :, : seq_len - stride] = -100
+        data["labels"] = labels
 
-    # Split by Chunks of Maximum Length
-    # we want to take chunks up until we've covered all "total_length" tokens with a sliding window of size "stride"
-    for begin in range(0, total_length - seq_len + stride, stride):
-        data = {k: v[begin : begin + seq_len] for k, v in concatenated.items()}
+    return data
 
-        if mask_stride_overlap and stride != seq_len:
-            labels = data.get("labels", data["input_ids"])
-            if begin != 0:
-                labels = _mask_overlap(labels, seq_len, stride)
-            data["labels"] = labels
 
-        yield BatchEncoding(data=data)
+def _strided_windows(array: np.ndarray, seq_len: int, stride: int, num_windows: int) -> np.ndarray:
+    if num_windows == 0:
+        return array[:0].reshape(0, seq_len)
+    return np.lib.stride_tricks.sliding_window_view(array[: (num_windows - 1) * stride + seq_len], seq_len)[::stride]
 
 
 # -100 is pytorch's label mask
@@ -1,16 +1,13 @@
 import argparse
-from collections import Counter
+from functools import partial
 import json
 import numpy as np
 import os
 from pathlib import Path
-from tqdm import tqdm
 
 import sys
 sys.path.append('..')
-from utils import get_distribution, LINE_LENGTH, CORPUS_LENGTHS
-
-MAX_CLOSING_DISPLACEMENT = 3
+from utils import get_distribution, LINE_LENGTH, CORPUS_LENGTHS, CategoricalSampler, generate_split, split_seeds
 
 def main():
     parser = argparse.ArgumentParser()
@@ -19,7 +16,11 @@ def main():
     parser.add_argument("--vocab-size", type=int, default = 50_000)
     parser.add_argument("--vocab-distribution", type=str, default = None)
     parser.add_argument("--paired", type=bool, default = False)
+    parser.add_argument("--text", action="store_true", default = False)
+    parser.add_argument("--seed", type=int, default = None)
+    parser.add_argument("--num-workers", type=int, default = 1)
     args = parser.parse_args()
+    np.random.seed(args.seed)
     output_dir = f"../../data/sparse{args.match_probability}-constant{args.deplength}"
     if args.vocab_size > 1_000:
         output_dir += f"_vocab{args.vocab_size // 1000}K"
@@ -33,40 +34,50 @@ def main():
     word2idx = dict([(str(i), i) for i in range(args.vocab_size)])
     json.dump(word2idx, open(os.path.join(output_dir, f"vocab_limit{args.vocab_size}.json"), "w"))
 
-    word_indices, vocab_ps = get_distribution(args.vocab_distribution, args.vocab_size)
     if args.paired:
         word_indices, vocab_ps = get_distribution(args.vocab_distribution, args.vocab_size // 2)
-        match_index = {word_i: args.vocab_size // 2 + word_i for word_i in word_indices}
+        close_offset = args.vocab_size // 2
     else:
         word_indices, vocab_ps = get_distribution(args.vocab_distribution, args.vocab_size)
-        match_index = {word_i: word_i for word_i in word_indices}
-    
-    for split in ["valid", "train", "test"]:
-        output_filename = os.path.join(output_dir, f"{split}.txt")
+        close_offset = 0
+    make_lines = partial(
+        sparse_lines,
+        vocab_sampler=CategoricalSampler(word_indices, vocab_ps),
+        deplength=args.deplength,
+        match_probability=args.match_probability,
+        close_offset=close_offset,
+    )
+
+    for split, split_seed in split_seeds(args.seed).items():
         print(f"On {split} split")
         split_length = CORPUS_LENGTHS[split]
         num_lines = split_length // LINE_LENGTH
         print(f"Going to make {num_lines} lines, for a corpus of {split_length} tokens")
-        split_length = num_lines * LINE_LENGTH
-        output = -1 * np.ones((num_lines, LINE_LENGTH))
-        # Sampling all of the words in one go greatly increases speed. 
-        # Just flipping all coins in advance, does not change process.
-        print("Frontloading all random samples, which might take a bit")
-        vocab_samples = np.random.choice(word_indices, (num_lines, LINE_LENGTH), p=vocab_ps)
-        match_samples = np.random.choice([0, 1], (num_lines, LINE_LENGTH), p=[1 - args.match_probability, args.match_probability])
-        print("Done!")
-        for line_i in tqdm(range(num_lines), desc="[Generating samples]"):
-            for word_i in range(LINE_LENGTH):
-                # Check if this index is already taken by the closing
-                # parenthesis of an earlier open.
-                if output[line_i, word_i] >= 0:
-                    continue
-                chosen_word = vocab_samples[line_i, word_i]
-                output[line_i, word_i] = chosen_word
-                if match_samples[line_i, word_i] == 1:
-                    if word_i < LINE_LENGTH - args.deplength:
-                        output[line_i, word_i + args.deplength] = match_index[chosen_word]
-        np.savetxt(output_filename, output, delimiter = " ", fmt = "%d")
+        generate_split(
+            output_dir, split, num_lines, args.vocab_size, make_lines, split_seed, args.num_workers, args.text
+        )
+
+def sparse_lines(num_lines, rng, vocab_sampler, deplength, match_probability, close_offset):
+    """
+    Makes `num_lines` lines where, going left to right, every free slot gets a word from the vocab distribution, and
+    with probability `match_probability` its match (the word plus `close_offset`) is put exactly `deplength` later.
+
+    Whether a slot is free only depends on the slot `deplength` before it, so the lines are built `deplength` columns
+    at a time.
+    """
+    vocab_samples = vocab_sampler.sample((num_lines, LINE_LENGTH), rng).astype(np.int64)
+    match_samples = rng.random((num_lines, LINE_LENGTH)) < match_probability
+    output = np.full((num_lines, LINE_LENGTH), -1, dtype=np.int64)
+    for start in range(0, LINE_LENGTH, deplength):
+        end = min(start + deplength, LINE_LENGTH)
+        # Check if this index is already taken by the closing
+        # parenthesis of an earlier open.
+        opens = output[:, start:end] < 0
+        output[:, start:end][opens] = vocab_samples[:, start:end][opens]
+        num_closes = max(0, min(deplength, LINE_LENGTH - end))
+        closes = (opens & match_samples[:, start:end])[:, :num_closes]
+        output[:, end : end + num_closes][closes] = output[:, start : start + num_closes][closes] + close_offset
+    return output
 
 if __name__ == "__main__":
     main()
@@ -1,16 +1,12 @@
 import argparse
-from collections import Counter
+from functools import partial
 import json
 import numpy as np
 import os
-import pickle
-from tqdm import tqdm
 
 import sys
 sys.path.append('..')
-from utils import get_distribution, LINE_LENGTH, CORPUS_LENGTHS
-
-MAX_CLOSING_DISPLACEMENT = 3
+from utils import get_distribution, LINE_LENGTH, CORPUS_LENGTHS, CategoricalSampler, find_closing_slots, generate_split, split_seeds
 
 def main():
     parser = argparse.ArgumentParser()
@@ -18,7 +14,11 @@ def main():
     parser.add_argument("--vocab-size", type=int, default = 50_000)
     parser.add_argument("--vocab-distribution", type=str, default = None)
     parser.add_argument("--paired", action="store_true", default = False)
+    parser.add_argument("--text", action="store_true", default = False)
+    parser.add_argument("--seed", type=int, default = None)
+    parser.add_argument("--num-workers", type=int, default = 1)
     args = parser.parse_args()
+    np.random.seed(args.seed)
     output_dir = "../../data/flat-parens"
     if args.vocab_size > 1_000:
         output_dir += f"_vocab{args.vocab_size // 1000}K"
@@ -37,68 +37,62 @@ def main():
     json.dump(word2idx, open(os.path.join(output_dir, f"vocab_limit{args.vocab_size}.json"), "w"))
     deplengths = json.load(open(os.path.join("dependency_lengths", f"deplengths_{args.deplength_distribution}.json"), 'r'))
     print(np.array(list(deplengths.values())))
+    deplength_keys = [int(key) for key in deplengths.keys()]
     deplength_ps = np.array(list(deplengths.values())) / sum(deplengths.values())
 
     # If we're pairing open and close tokens, we pair the first half of the vocab size 
     # with the second half.
     if args.paired:
         word_indices, vocab_ps = get_distribution(args.vocab_distribution, args.vocab_size // 2)
-        match_index = {word_i: args.vocab_size // 2 + word_i for word_i in word_indices}
+        close_offset = args.vocab_size // 2
     else:
         word_indices, vocab_ps = get_distribution(args.vocab_distribution, args.vocab_size)
-        match_index = {word_i: word_i for word_i in word_indices}
-    real_deplengths = Counter()
+        close_offset = 0
+    make_lines = partial(
+        flat_lines,
+        vocab_sampler=CategoricalSampler(word_indices, vocab_ps),
+        deplength_sampler=CategoricalSampler(deplength_keys, deplength_ps),
+        close_offset=close_offset,
+    )
+    real_deplengths = np.zeros(LINE_LENGTH, dtype=np.int64)
 
-    for split in ["valid", "train", "test"]:
-        output_filename = os.path.join(output_dir, f"{split}.txt")
+    for split, split_seed in split_seeds(args.seed).items():
         print(f"On {split} split")
         split_length = CORPUS_LENGTHS[split]
         num_lines = split_length // LINE_LENGTH
         print(f"Going to make {num_lines} lines, for a corpus of {split_length} tokens")
-        split_length = num_lines * LINE_LENGTH
-        output = -1 * np.ones((num_lines, LINE_LENGTH))
-        # Sampling all of the words in one go greatly increases speed. 
-        # Just flipping all coins in advance, does not change process.
-        print("Frontloading all random samples, which might take a bit")
-        vocab_samples = np.random.choice(word_indices, (num_lines, LINE_LENGTH), p=vocab_ps)
-        deplength_keys = [int(key) for key in deplengths.keys()]
-        deplength_samples = np.random.choice(deplength_keys, (num_lines, LINE_LENGTH), p=deplength_ps)
-        print("Done!")
-        for line_i in tqdm(range(num_lines), desc="[Generating samples]"):
-            for word_i in range(LINE_LENGTH):
-                # Check if this index is already taken by the closing
-                # parenthesis of an earlier open.
-                if output[line_i, word_i] >= 0:
-                    continue
-                chosen_word = vocab_samples[line_i, word_i]
-                output[line_i, word_i] = chosen_word
-                deplength = deplength_samples[line_i, word_i]
-                closing_index = word_i + deplength
-                if closing_index >= LINE_LENGTH:
-                    continue
-                if output[line_i, closing_index] < 0:
-                    output[line_i, closing_index] = match_index[chosen_word]
-                    real_deplengths[closing_index - word_i] += 1
-                else:
-                    # Look around the original sampled index to find the closest open
-                    # spot.
-                    displacement = 1
-                    found_spot = False
-                    while not found_spot and \
-                        displacement < MAX_CLOSING_DISPLACEMENT and \
-                        (closing_index - displacement >= 0 or closing_index + displacement < LINE_LENGTH):
-                        if closing_index - displacement >= 0 and output[line_i, closing_index - displacement] < 0:
-                            output[line_i, closing_index - displacement] = match_index[chosen_word]
-                            found_spot = True
-                            real_deplengths[closing_index - displacement - word_i] += 1
-                        elif closing_index + displacement < LINE_LENGTH and output[line_i, closing_index + displacement] < 0:
-                            output[line_i, closing_index + displacement] = match_index[chosen_word]
-                            found_spot = True
-                            real_deplengths[closing_index + displacement - word_i] += 1
-                        displacement += 1
-        np.savetxt(output_filename, output, delimiter = " ", fmt = "%d")
+        (split_deplengths,) = generate_split(
+            output_dir, split, num_lines, args.vocab_size, make_lines, split_seed, args.num_workers, args.text
+        )
+        real_deplengths += split_deplengths
     json.dump(deplengths, open(os.path.join(output_dir, "deplenghts.json"), "w"))
+    json.dump(
+        {str(length): int(count) for length, count in enumerate(real_deplengths) if count > 0},
+        open(os.path.join(output_dir, "real_deplengths.json"), "w"),
+    )
+
+def flat_lines(num_lines, rng, vocab_sampler, deplength_sampler, close_offset):
+    """
+    Makes `num_lines` lines of flat dependencies. Going left to right, every free slot opens a dependency with a word
+    from the vocab distribution, and its match (the word plus `close_offset`) is put a sampled dependency length
+    later, or in the nearest free slot around it (see `find_closing_slots`).
+
+    The lines are independent, so they are all walked at once, one position at a time. Also returns the histogram of
+    the dependency lengths that were actually realized.
+    """
+    vocab_samples = vocab_sampler.sample((num_lines, LINE_LENGTH), rng).astype(np.int64)
+    deplength_samples = deplength_sampler.sample((num_lines, LINE_LENGTH), rng)
+    output = np.full((num_lines, LINE_LENGTH), -1, dtype=np.int64)
+    real_deplengths = np.zeros(LINE_LENGTH, dtype=np.int64)
+    for word_i in range(LINE_LENGTH):
+        # Skip the indices already taken by the closing parenthesis of an earlier open.
+        rows = np.flatnonzero(output[:, word_i] < 0)
+        output[rows, word_i] = vocab_samples[rows, word_i]
+        slots = find_closing_slots(output, rows, word_i + deplength_samples[rows, word_i])
+        found = slots >= 0
+        output[rows[found], slots[found]] = vocab_samples[rows[found], word_i] + close_offset
+        real_deplengths += np.bincount(slots[found] - word_i, minlength=LINE_LENGTH)
+    return output, real_deplengths
 
 if __name__ == "__main__":
     main()
-
@@ -1,16 +1,13 @@
 import argparse
-from collections import deque
+from functools import partial
 import json
 import numpy as np
 import os
 from pathlib import Path
-from tqdm import tqdm
 
 import sys
 sys.path.append('..')
-from utils import get_distribution, LINE_LENGTH, CORPUS_LENGTHS
-
-MAX_CLOSING_DISPLACEMENT = 3
+from utils import get_distribution, LINE_LENGTH, CORPUS_LENGTHS, CategoricalSampler, find_closing_slots, generate_split, split_seeds
 
 def main():
     parser = argparse.ArgumentParser()
@@ -20,8 +17,12 @@ def main():
     parser.add_argument("--vocab-distribution", type=str, default = None)
     parser.add_argument("--deplength-distribution", type=str, default = None)
     parser.add_argument("--paired", action="store_true", default = False)
+    parser.add_argument("--text", action="store_true", default = False)
+    parser.add_argument("--seed", type=int, default = None)
+    parser.add_argument("--num-workers", type=int, default = 1)
     args = parser.parse_args()
     print(args)
+    np.random.seed(args.seed)
     output_dir = f"../../data/mixed-parens{args.mix_prob}"
     if args.vocab_size > 1_000:
         output_dir += f"_vocab{args.vocab_size // 1000}K"
@@ -35,67 +36,65 @@ def main():
     print(f"Writing dataset to {output_dir}")
     if args.paired:
         word_indices, vocab_ps = get_distribution(args.vocab_distribution, args.vocab_size // 2)
-        match_index = {word_i: args.vocab_size // 2 + word_i for word_i in word_indices}
+        close_offset = args.vocab_size // 2
     else:
         word_indices, vocab_ps = get_distribution(args.vocab_distribution, args.vocab_size)
-        match_index = {word_i: word_i for word_i in word_indices}
+        close_offset = 0
 
     deplengths = json.load(open(os.path.join("dependency_lengths", f"deplengths_{args.deplength_distribution}.json"), 'r'))
     deplength_ps = np.array(list(deplengths.values())) / sum(deplengths.values())
 
-    for split in ["valid", "test", "train"]:
-        output_filename = os.path.join(output_dir, f"{split}.txt")
+    make_lines = partial(
+        mixed_lines,
+        vocab_sampler=CategoricalSampler(word_indices, vocab_ps),
+        deplength_sampler=CategoricalSampler([int(key) for key in deplengths.keys()], deplength_ps),
+        open_prob=args.open_prob,
+        mix_prob=args.mix_prob,
+        close_offset=close_offset,
+    )
+
+    for split, split_seed in split_seeds(args.seed, ["valid", "test", "train"]).items():
         print(f"On {split} split")
         split_length = CORPUS_LENGTHS[split]
         num_lines = split_length // LINE_LENGTH
         print(f"Going to make {num_lines} lines, for a corpus of {split_length} tokens")
-        split_length = num_lines * LINE_LENGTH
-        output = -1 * np.ones((num_lines, LINE_LENGTH))
-        # Sampling all of the words in one go greatly increases speed. 
-        # Just flipping all coins in advance, does not change process.
-        print("Frontloading all random samples, which might take a bit")
-        vocab_samples = np.random.choice(word_indices, (num_lines, LINE_LENGTH), p=vocab_ps)
-        open_samples = np.random.choice([0, 1], (num_lines, LINE_LENGTH), p=[1 - args.open_prob, args.open_prob])
-        deplength_keys = [int(key) for key in deplengths.keys()]
-        deplength_samples = np.random.choice(deplength_keys, (num_lines, LINE_LENGTH), p=deplength_ps)
-        mix_samples = np.random.choice([0, 1], (num_lines, LINE_LENGTH), p=[1 - args.mix_prob, args.mix_prob])
-        print("Done!")
-        for line_i in tqdm(range(num_lines), desc="[Generating samples]"):
-            stack = deque()
-            for word_i in range(LINE_LENGTH):
-                if output[line_i, word_i] >= 0:
-                    continue
-                if mix_samples[line_i, word_i]:
-                    chosen_word = vocab_samples[line_i, word_i]
-                    output[line_i, word_i] = chosen_word
-                    deplength = deplength_samples[line_i, word_i]
-                    closing_index = word_i + deplength
-                    if closing_index >= LINE_LENGTH:
-                        continue
-                    if output[line_i, closing_index] < 0:
-                        output[line_i, closing_index] = match_index[chosen_word]
-                    else:
-                        # Look around the original sampled index to find the closest open
-                        # spot.
-                        displacement = 1
-                        found_spot = False
-                        while not found_spot and \
-                            displacement < MAX_CLOSING_DISPLACEMENT and \
-                            (closing_index - displacement >= 0 or closing_index + displacement < LINE_LENGTH):
-                            if closing_index - displacement >= 0 and output[line_i, closing_index - displacement] < 0:
-                                output[line_i, closing_index - displacement] = match_index[chosen_word]
-                                found_spot = True
-                            elif closing_index + displacement < LINE_LENGTH and output[line_i, closing_index + displacement] < 0:
-                                output[line_i, closing_index + displacement] = match_index[chosen_word]
-                                found_spot = True
-                            displacement += 1
-                else:
-                    if open_samples[line_i, word_i] == 1 or len(stack) == 0:
-                        output[line_i, word_i] = vocab_samples[line_i, word_i]
-                        stack.append(output[line_i, word_i])
-                    else:
-                        output[line_i, word_i] = match_index[stack.pop()]
-        np.savetxt(output_filename, output, delimiter = " ", fmt = "%d")
+        generate_split(
+            output_dir, split, num_lines, args.vocab_size, make_lines, split_seed, args.num_workers, args.text
+        )
+
+def mixed_lines(num_lines, rng, vocab_sampler, deplength_sampler, open_prob, mix_prob, close_offset):
+    """
+    Makes `num_lines` lines that mix flat and nested parentheses: at every free slot, with probability `mix_prob` a
+    flat dependency is opened (see flat_deps.py), and otherwise the nested stack is pushed or popped as in
+    nested_parens.py.
+
+    The lines are independent, so they are all walked at once, one position at a time, each with its own stack.
+    """
+    output = np.full((num_lines, LINE_LENGTH), -1, dtype=np.int64)
+    vocab_samples = vocab_sampler.sample((num_lines, LINE_LENGTH), rng).astype(np.int64)
+    open_samples = rng.random((num_lines, LINE_LENGTH)) < open_prob
+    deplength_samples = deplength_sampler.sample((num_lines, LINE_LENGTH), rng)
+    mix_samples = rng.random((num_lines, LINE_LENGTH)) < mix_prob
+    stacks = np.empty((num_lines, LINE_LENGTH), dtype=np.int64)
+    depths = np.zeros(num_lines, dtype=np.int64)
+    for word_i in range(LINE_LENGTH):
+        # Skip the indices already taken by the closing parenthesis of an earlier flat open.
+        free = output[:, word_i] < 0
+        flat = np.flatnonzero(free & mix_samples[:, word_i])
+        pushes = np.flatnonzero(free & ~mix_samples[:, word_i] & (open_samples[:, word_i] | (depths == 0)))
+        pops = np.flatnonzero(free & ~mix_samples[:, word_i] & ~open_samples[:, word_i] & (depths > 0))
+
+        output[flat, word_i] = vocab_samples[flat, word_i]
+        slots = find_closing_slots(output, flat, word_i + deplength_samples[flat, word_i])
+        found = slots >= 0
+        output[flat[found], slots[found]] = vocab_samples[flat[found], word_i] + close_offset
+
+        output[pushes, word_i] = vocab_samples[pushes, word_i]
+        stacks[pushes, depths[pushes]] = vocab_samples[pushes, word_i]
+        depths[pushes] += 1
+        depths[pops] -= 1
+        output[pops, word_i] = stacks[pops, depths[pops]] + close_offset
+    return output
 
 if __name__ == "__main__":
     main()
@@ -1,13 +1,11 @@
 import argparse
-from collections import deque
+from functools import partial
 import numpy as np
-import os
 from pathlib import Path
-from tqdm import tqdm
 
 import sys
 sys.path.append('..')
-from utils import get_distribution, LINE_LENGTH, CORPUS_LENGTHS
+from utils import get_distribution, LINE_LENGTH, CORPUS_LENGTHS, CategoricalSampler, generate_split, split_seeds
 
 def main():
     parser = argparse.ArgumentParser()
@@ -15,8 +13,12 @@ def main():
     parser.add_argument("--vocab-size", type=int, default = 50_000)
     parser.add_argument("--vocab-distribution", type=str, default = None)
     parser.add_argument("--paired", action="store_true", default = False)
+    parser.add_argument("--text", action="store_true", default = False)
+    parser.add_argument("--seed", type=int, default = None)
+    parser.add_argument("--num-workers", type=int, default = 1)
     args = parser.parse_args()
     print(args)
+    np.random.seed(args.seed)
     output_dir = f"../../data/nested-parens{args.open_prob}"
     if args.vocab_size > 1_000:
         output_dir += f"_vocab{args.vocab_size // 1000}K"
@@ -28,37 +30,61 @@ def main():
     output_dir = Path(output_dir)
     output_dir.mkdir(exist_ok=True)
     print(f"Writing dataset to {output_dir}")
+    # If we're pairing open and close tokens, we pair the first half of the vocab
+    # with the second half.
     if args.paired:
         word_indices, vocab_ps = get_distribution(args.vocab_distribution, args.vocab_size // 2)
-        match_index = {word_i: args.vocab_size // 2 + word_i for word_i in word_indices}
+        close_offset = args.vocab_size // 2
     else:
         word_indices, vocab_ps = get_distribution(args.vocab_distribution, args.vocab_size)
-        match_index = {word_i: word_i for word_i in word_indices}
-    # import IPython; IPython.embed()
+        close_offset = 0
 
-    for split in ["valid", "train", "test"]:
-        output_filename = os.path.join(output_dir, f"{split}.txt")
+    make_lines = partial(
+        nested_lines,
+        vocab_sampler=CategoricalSampler(word_indices, vocab_ps),
+        open_prob=args.open_prob,
+        close_offset=close_offset,
+    )
+
+    for split, split_seed in split_seeds(args.seed).items():
         print(f"On {split} split")
         split_length = CORPUS_LENGTHS[split]
         num_lines = split_length // LINE_LENGTH
         print(f"Going to make {num_lines} lines, for a corpus of {split_length} tokens")
-        split_length = num_lines * LINE_LENGTH
-        output = -1 * np.ones((num_lines, LINE_LENGTH))
-        # Sampling all of the words in one go greatly increases speed. 
-        # It's just flipping all coins in advance, does not actually change the process.
-        print("Frontloading all random samples, which might take a bit")
-        vocab_samples = np.random.choice(word_indices, (num_lines, LINE_LENGTH), p=vocab_ps)
-        open_samples = np.random.choice([0, 1], (num_lines, LINE_LENGTH), p=[1 - args.open_prob, args.open_prob])
-        print("Done!")
-        for line_i in tqdm(range(num_lines), desc="[Generating samples]"):
-            stack = deque()
-            for word_i in range(LINE_LENGTH):
-                if open_samples[line_i, word_i] == 1 or len(stack) == 0:
-                    output[line_i, word_i] = vocab_samples[line_i, word_i]
-                    stack.append(output[line_i, word_i])
-                else:
-                    output[line_i, word_i] = match_index[stack.pop()]
-        np.savetxt(output_filename, output, delimiter = " ", fmt = "%d")
+        generate_split(
+            output_dir, split, num_lines, args.vocab_size, make_lines, split_seed, args.num_workers, args.text
+        )
+
+def nested_lines(num_lines, rng, vocab_sampler, open_prob, close_offset):
+    """
+    Makes `num_lines` lines of nested parentheses, as if walking each line with a stack: every token opens a new
+    parenthesis (a word drawn from the vocab distribution) with probability `open_prob`, or when the stack is empty,
+    and otherwise closes the last open one with its match (the same word plus `close_offset`).
+
+    The stack is never materialized. Its depth after each token is a cumulative sum of +1/-1 steps, corrected for the
+    closes on an empty stack that are turned into opens. Each close is then matched to its open by sorting.
+    """
+    steps = np.where(rng.random((num_lines, LINE_LENGTH)) < open_prob, 1, -1)
+    walk = np.cumsum(steps, axis=1)
+    # A close on an empty stack opens instead, which lifts the rest of the line by 2. That happens exactly when the
+    # unconstrained walk reaches a new odd minimum, so the number of forced opens so far is ceil(-minimum / 2)
+    forced_opens = (1 - np.minimum(np.minimum.accumulate(walk, axis=1), 0)) // 2
+    depth = walk + 2 * forced_opens
+    prev_depth = np.concatenate([np.zeros((num_lines, 1), dtype=depth.dtype), depth[:, :-1]], axis=1)
+    is_open = depth > prev_depth
+
+    output = np.empty((num_lines, LINE_LENGTH), dtype=np.int64)
+    output[is_open] = vocab_sampler.sample(np.count_nonzero(is_open), rng)
+
+    # An open sits at the depth it leads to and a close at the depth it leaves. Within a line, the parentheses at one
+    # depth alternate open, close, open, ... so sorting by (line, depth, position) puts every close right after its open
+    lines, columns = np.indices((num_lines, LINE_LENGTH))
+    level = np.where(is_open, depth, prev_depth)
+    order = np.argsort(((lines * (LINE_LENGTH + 1) + level) * LINE_LENGTH + columns).reshape(-1))
+    closes = np.flatnonzero(~is_open.reshape(-1)[order])
+    tokens = output.reshape(-1)
+    tokens[order[closes]] = tokens[order[closes - 1]] + close_offset
+    return output
 
 if __name__ == "__main__":
     main()
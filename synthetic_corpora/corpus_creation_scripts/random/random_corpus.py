@@ -1,16 +1,15 @@
 import argparse
-from collections import Counter
+from functools import partial
 import json
 import numpy as np
 import os
 from pathlib import Path
 import pickle
-from tqdm import tqdm
 
 import sys
 sys.path.append('..')
 
-from utils import get_distribution
+from utils import get_distribution, CategoricalSampler, generate_split, split_seeds
 
 LINE_LENGTH = 512
 # Corpus length is in tokens, number of lines computed in the code
@@ -21,7 +20,11 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--vocab-size", type=int, default = 50_000)
     parser.add_argument("--vocab-distribution", type=str, choices = ["zipf", "uniform"])
+    parser.add_argument("--text", action="store_true", default = False)
+    parser.add_argument("--seed", type=int, default = None)
+    parser.add_argument("--num-workers", type=int, default = 1)
     args = parser.parse_args()
+    np.random.seed(args.seed)
     output_dir = "../../data/random"
     if args.vocab_size > 1_000:
         output_dir += f"_vocab{args.vocab_size // 1000}K"
@@ -33,20 +36,19 @@ def main():
     word2idx = dict([(str(i), i) for i in range(args.vocab_size)])
     json.dump(word2idx, open(os.path.join(output_dir, f"vocab_limit{args.vocab_size}.json"), "w"))
     word_indices, vocab_ps = get_distribution(args.vocab_distribution, args.vocab_size)
-    
-    for split in ["valid", "train", "test"]:
-        output_filename = os.path.join(output_dir, f"{split}.txt")
+    make_lines = partial(random_lines, vocab_sampler=CategoricalSampler(word_indices, vocab_ps))
+
+    for split, split_seed in split_seeds(args.seed).items():
         print(f"On {split} split")
         split_length = CORPUS_LENGTHS[split]
         num_lines = split_length // LINE_LENGTH
         print(f"Going to make {num_lines} lines, for a corpus of {split_length} tokens")
-        split_length = num_lines * LINE_LENGTH
-        # Sampling all of the words in one go greatly increases speed. 
-        # We're just flipping all coins in advance, does not change process.
-        print("Frontloading all random samples, which might take a bit")
-        vocab_samples = np.random.choice(word_indices, (num_lines, LINE_LENGTH), p=vocab_ps)
-        print("Done!")
-        np.savetxt(output_filename, vocab_samples, delimiter = " ", fmt = "%d")
+        generate_split(
+            output_dir, split, num_lines, args.vocab_size, make_lines, split_seed, args.num_workers, args.text
+        )
+
+def random_lines(num_lines, rng, vocab_sampler):
+    return vocab_sampler.sample((num_lines, LINE_LENGTH), rng)
 
 if __name__ == "__main__":
     main()
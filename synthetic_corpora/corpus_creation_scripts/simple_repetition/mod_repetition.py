@@ -1,12 +1,13 @@
 import argparse
-from collections import Counter
+from functools import partial
 import json
 import numpy as np
-import os
 from pathlib import Path
 import pickle
-import random
-from tqdm import tqdm
+
+import sys
+sys.path.append('..')
+from utils import CategoricalSampler, repeated_positions, generate_split, split_seeds
 
 LINE_LENGTH = 512
 # Corpus length is in tokens, number of lines computed in the code
@@ -18,7 +19,11 @@ def main():
     parser.add_argument("--mod", type=int, default = 10)
     parser.add_argument("--vocab-size", type=int, default = 500)
     parser.add_argument("--vocab-distribution", type=str, default = "zipf-simple")
+    parser.add_argument("--text", action="store_true", default = False)
+    parser.add_argument("--seed", type=int, default = None)
+    parser.add_argument("--num-workers", type=int, default = 1)
     args = parser.parse_args()
+    np.random.seed(args.seed)
     output_dir = f"../../data/mod{args.mod}_repetition{args.len_repeating}"
     if args.vocab_size != 50_000:
         # Only mark vocab size on filename if it's not the default, to reduce filename cluttering
@@ -32,36 +37,47 @@ def main():
     word_indices, vocab_ps = get_distribution(args.vocab_distribution, args.vocab_size)
     num_quotients = (len(word_indices) // args.mod) + 1
     remainders_dist, quotients_dists = get_remainder_quotient_distribution(word_indices, vocab_ps, args.mod)
-    for split in ["valid", "train", "test"]:
-        output_filename = output_dir / f"{split}.txt"
+    quotient_samplers = {
+        remainder: CategoricalSampler(np.arange(num_quotients), quotients_dists[remainder])
+        for remainder in range(args.mod)
+        if remainders_dist[remainder] > 0
+    }
+    make_lines = partial(
+        mod_lines,
+        remainder_sampler=CategoricalSampler(np.arange(args.mod), remainders_dist),
+        quotient_samplers=quotient_samplers,
+        len_repeating=args.len_repeating,
+        mod=args.mod,
+    )
+
+    for split, split_seed in split_seeds(args.seed).items():
         print(f"On {split} split")
         split_length = CORPUS_LENGTHS[split]
         num_lines = split_length // LINE_LENGTH
         print(f"Going to make {num_lines} lines, for a corpus of {split_length} tokens")
-        split_length = num_lines * LINE_LENGTH
-        output = -1 * np.ones((num_lines, LINE_LENGTH))
-        # Sampling all of the words in one go greatly increases speed. 
-        # It's just flipping all coins in advance, does not change process.
-        print("Frontloading all random samples, which might take a bit")
-        # Since we're doing mods, we need to sample the remainders and the quotients separately.
-        # So, say we're mod 10, and the remainder is 1. To know what number we will actually
-        # put, we look at the quotient. Say it's 4, we put 41
-        remainder_samples = np.random.choice(range(args.mod), (num_lines, LINE_LENGTH), p=remainders_dist)
-        print("Done!")
-        for line_i in tqdm(range(num_lines), desc="[Generating samples]"):
-            for word_i in range(0, LINE_LENGTH, args.len_repeating * 2):
-                segment_length = min(LINE_LENGTH - word_i, args.len_repeating * 2)
-                segment = np.zeros(segment_length)
-                for segment_i in range(min(segment_length, args.len_repeating)):
-                    remainder = remainder_samples[line_i, word_i + segment_i]
-                    quotient = random.choices(range(num_quotients), weights=quotients_dists[remainder], k=1)[0]
-                    segment[segment_i] = quotient*args.mod + remainder
-                for segment_i in range(args.len_repeating, min(segment_length, args.len_repeating * 2)):
-                    remainder = remainder_samples[line_i, word_i + segment_i - args.len_repeating]
-                    quotient = random.choices(range(num_quotients), weights=quotients_dists[remainder], k=1)[0]
-                    segment[segment_i] = quotient*args.mod + remainder
-                output[line_i,word_i : word_i + segment_length] = segment
-        np.savetxt(output_filename, output, delimiter = " ", fmt = "%d")
+        generate_split(
+            output_dir, split, num_lines, args.vocab_size, make_lines, split_seed, args.num_workers, args.text
+        )
+
+def mod_lines(num_lines, rng, remainder_sampler, quotient_samplers, len_repeating, mod):
+    """
+    Makes `num_lines` lines of segments of `len_repeating` words followed by words with the same remainders mod `mod`.
+    """
+    # Since we're doing mods, we need to sample the remainders and the quotients separately.
+    # So, say we're mod 10, and the remainder is 1. To know what number we will actually
+    # put, we look at the quotient. Say it's 4, we put 41
+    # The second half of a segment repeats the remainders of the first, each word with its own quotient
+    remainder_samples = remainder_sampler.sample((num_lines, LINE_LENGTH), rng)
+    sources, _ = repeated_positions(len_repeating)
+    return sample_words(remainder_samples[:, sources], quotient_samplers, mod, rng)
+
+def sample_words(remainders, quotient_samplers, mod, rng):
+    """Draws a word for every remainder in `remainders`: the remainder plus `mod` times a quotient from its sampler."""
+    words = np.empty(remainders.shape, dtype=np.int64)
+    for remainder, quotient_sampler in quotient_samplers.items():
+        at_remainder = remainders == remainder
+        words[at_remainder] = quotient_sampler.sample(np.count_nonzero(at_remainder), rng) * mod + remainder
+    return words
 
 
 def get_distribution(vocab_distribution, vocab_size):
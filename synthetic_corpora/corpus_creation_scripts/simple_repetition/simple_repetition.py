@@ -1,11 +1,13 @@
 import argparse
-from collections import Counter
+from functools import partial
 import json
 import numpy as np
-import os
 from pathlib import Path
 import pickle
-from tqdm import tqdm
+
+import sys
+sys.path.append('..')
+from utils import CategoricalSampler, repeated_positions, generate_split, split_seeds
 
 LINE_LENGTH = 512
 # Corpus length is in tokens, number of lines computed in the code
@@ -17,7 +19,11 @@ def main():
     parser.add_argument("--vocab-size", type=int, default = 500)
     parser.add_argument("--vocab-distribution", type=str, default = "zipf")
     parser.add_argument("--paired", action="store_true", default = False)
+    parser.add_argument("--text", action="store_true", default = False)
+    parser.add_argument("--seed", type=int, default = None)
+    parser.add_argument("--num-workers", type=int, default = 1)
     args = parser.parse_args()
+    np.random.seed(args.seed)
     output_dir = f"../../data/simple_repetition{args.len_repeating}"
     if args.vocab_size > 1_000:
         output_dir += f"_vocab{args.vocab_size // 1000}K"
@@ -32,33 +38,31 @@ def main():
     json.dump(word2idx, open(output_dir / f"vocab_limit{args.vocab_size}.json", "w"))
     if args.paired:
         word_indices, vocab_ps = get_distribution(args.vocab_distribution, args.vocab_size // 2)
-        match_index = {word_i: args.vocab_size // 2 + word_i for word_i in word_indices}
+        close_offset = args.vocab_size // 2
     else:
         word_indices, vocab_ps = get_distribution(args.vocab_distribution, args.vocab_size)
-        match_index = {word_i: word_i for word_i in word_indices}
-    for split in ["valid", "train", "test"]:
-        output_filename = output_dir / f"{split}.txt"
+        close_offset = 0
+    make_lines = partial(
+        simple_lines,
+        vocab_sampler=CategoricalSampler(word_indices, vocab_ps),
+        len_repeating=args.len_repeating,
+        close_offset=close_offset,
+    )
+
+    for split, split_seed in split_seeds(args.seed).items():
         print(f"On {split} split")
         split_length = CORPUS_LENGTHS[split]
         num_lines = split_length // LINE_LENGTH
         print(f"Going to make {num_lines} lines, for a corpus of {split_length} tokens")
-        split_length = num_lines * LINE_LENGTH
-        output = -1 * np.ones((num_lines, LINE_LENGTH))
-        # Sampling all of the words in one go greatly increases speed. 
-        # Just flipping all coins in advance, does not change process.
-        print("Frontloading all random samples, which might take a bit")
-        vocab_samples = np.random.choice(word_indices, (num_lines, LINE_LENGTH), p=vocab_ps)
-        print("Done!")
-        for line_i in tqdm(range(num_lines), desc="[Generating samples]"):
-            for word_i in range(0, LINE_LENGTH, args.len_repeating * 2):
-                segment_length = min(LINE_LENGTH - word_i, args.len_repeating * 2)
-                segment = np.zeros(segment_length)
-                for segment_i in range(min(segment_length, args.len_repeating)):
-                    segment[segment_i] = vocab_samples[line_i, word_i + segment_i]
-                for segment_i in range(args.len_repeating, min(segment_length, args.len_repeating * 2)):
-                    segment[segment_i] = match_index[vocab_samples[line_i, word_i + segment_i - args.len_repeating]] 
-                output[line_i, word_i : word_i + segment_length] = segment
-        np.savetxt(output_filename, output, delimiter = " ", fmt = "%d")
+        generate_split(
+            output_dir, split, num_lines, args.vocab_size, make_lines, split_seed, args.num_workers, args.text
+        )
+
+def simple_lines(num_lines, rng, vocab_sampler, len_repeating, close_offset):
+    """Makes `num_lines` lines of segments of `len_repeating` words followed by their matches (plus `close_offset`)."""
+    vocab_samples = vocab_sampler.sample((num_lines, LINE_LENGTH), rng)
+    sources, repeats = repeated_positions(len_repeating)
+    return vocab_samples[:, sources].astype(np.int64) + close_offset * repeats
 
 
 def get_distribution(vocab_distribution, vocab_size):
@@ -1,8 +1,23 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+
 import numpy as np
+from tqdm import tqdm
 
 LINE_LENGTH = 512
 # Corpus length is in tokens, number of lines computed in the code
 CORPUS_LENGTHS = {"train": 1_000_000_000, "test": 1_000_000, "valid": 500_000}
+# Every split draws from its own child of the corpus seed, spawned in this order
+SPLITS = ["valid", "train", "test"]
+# Generators build and write lines in blocks of this many lines, so a split is never held in memory at once
+CHUNK_LINES = 4096
+# How far a flat dependency's close may be moved (exclusive) when its sampled slot is already taken
+MAX_CLOSING_DISPLACEMENT = 3
+# Binary corpora are written as .npy shards of at most this many lines, described by the manifest
+LINES_PER_SHARD = 262_144
+MANIFEST_FILE = "manifest.json"
 
 def get_distribution(vocab_distribution, vocab_size=-1, vocab_distribution_file=""):
     if vocab_distribution == "zipf":
@@ -43,3 +58,221 @@ def get_distribution(vocab_distribution, vocab_size=-1, vocab_distribution_file=
     #    ps = frequencies / sum(frequencies)
     #    word_indices = np.arange(len(ps))
     #    return word_indices, ps
+
+
+class CategoricalSampler:
+    """
+    Draws `values` with probabilities `ps`, through a Walker alias table built once up front. Each draw then costs one
+    uniform and one table lookup, however many values there are, instead of a search through the CDF.
+    """
+
+    def __init__(self, values, ps):
+        self.values = np.asarray(values)
+        ps = np.asarray(ps, dtype=np.float64)
+        num_values = len(ps)
+        scaled = ps * (num_values / ps.sum())
+        self.accept = np.ones(num_values)
+        self.alias = np.arange(num_values)
+        small = [i for i in range(num_values) if scaled[i] < 1.0]
+        large = [i for i in range(num_values) if scaled[i] >= 1.0]
+        while small and large:
+            i, j = small.pop(), large[-1]
+            self.accept[i], self.alias[i] = scaled[i], j
+            scaled[j] -= 1.0 - scaled[i]
+            if scaled[j] < 1.0:
+                small.append(large.pop())
+        # Whatever is left has a scaled probability of 1, up to rounding error, so it always accepts
+
+    def sample(self, n, rng=np.random):
+        """Returns `n` draws (an int or a shape), using `rng` (a Generator, or the global state by default)."""
+        u = rng.random(n) * len(self.accept)
+        slots = np.minimum(u.astype(np.int64), len(self.accept) - 1)
+        return self.values[np.where(u - slots < self.accept[slots], slots, self.alias[slots])]
+
+
+def corpus_dtype(vocab_size):
+    # Token ids are in [0, vocab_size). A vocab size <= 0 means it isn't known up front (e.g. a matched distribution).
+    if 0 < vocab_size <= np.iinfo(np.uint16).max + 1:
+        return np.dtype(np.uint16)
+    return np.dtype(np.uint32)
+
+
+class CorpusWriter:
+    """
+    Writes one split of a corpus as `{split}-{shard}.npy` arrays of shape (lines, LINE_LENGTH), in the narrowest dtype
+    that fits the vocab, and records it in the output directory's manifest when closed. The shards are plain .npy
+    files, so they can be memory-mapped with np.load(..., mmap_mode="r"). If `text` is set, the split is also exported
+    to `{split}.txt` in the old np.savetxt format.
+
+    Lines can be written in blocks of any size, so a split never has to be held in memory at once:
+        with CorpusWriter(output_dir, "train", num_lines, vocab_size) as writer:
+            for block in blocks:
+                writer.write(block)
+    """
+
+    def __init__(self, output_dir, split, num_lines, vocab_size, text=False, lines_per_shard=LINES_PER_SHARD):
+        self.output_dir = output_dir
+        self.split = split
+        self.num_lines = num_lines
+        self.vocab_size = vocab_size
+        self.dtype = corpus_dtype(vocab_size)
+        self.lines_per_shard = lines_per_shard
+        self.shards = []
+        self.lines_written = 0
+        self.shard = None
+        self.shard_lines = 0
+        self.text_file = open(os.path.join(output_dir, f"{split}.txt"), "w") if text else None
+
+    def write(self, lines):
+        lines = np.asarray(lines)
+        if len(lines) == 0:
+            return
+        if lines.ndim != 2 or lines.shape[1] != LINE_LENGTH:
+            raise ValueError(f"Expected lines of shape (n, {LINE_LENGTH}), got {lines.shape}")
+        if self.lines_written + len(lines) > self.num_lines:
+            raise ValueError(f"Writing more than the {self.num_lines} lines of the {self.split} split")
+        if lines.min() < 0 or lines.max() > np.iinfo(self.dtype).max:
+            raise ValueError(f"Token ids out of range for {self.dtype.name}, is every position of every line filled?")
+        if self.text_file is not None:
+            np.savetxt(self.text_file, lines, delimiter=" ", fmt="%d")
+
+        while len(lines) > 0:
+            if self.shard is None:
+                self._open_shard()
+            n = min(len(lines), len(self.shard) - self.shard_lines)
+            self.shard[self.shard_lines : self.shard_lines + n] = lines[:n]
+            self.shard_lines += n
+            self.lines_written += n
+            lines = lines[n:]
+            if self.shard_lines == len(self.shard):
+                self._close_shard()
+
+    def close(self):
+        if self.lines_written != self.num_lines:
+            raise ValueError(f"Only {self.lines_written} of the {self.num_lines} lines of {self.split} were written")
+        self._close_shard()
+        if self.text_file is not None:
+            self.text_file.close()
+
+        manifest_path = os.path.join(self.output_dir, MANIFEST_FILE)
+        manifest = load_manifest(self.output_dir) if os.path.exists(manifest_path) else {"splits": {}}
+        manifest.update({"line_length": LINE_LENGTH, "dtype": self.dtype.name, "vocab_size": self.vocab_size})
+        manifest["splits"][self.split] = {
+            "num_lines": self.num_lines,
+            "num_tokens": self.num_lines * LINE_LENGTH,
+            "shards": self.shards,
+        }
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def _open_shard(self):
+        num_lines = min(self.lines_per_shard, self.num_lines - self.lines_written)
+        file_name = f"{self.split}-{len(self.shards):05d}.npy"
+        self.shards.append({"file_name": file_name, "num_lines": num_lines})
+        self.shard = np.lib.format.open_memmap(
+            os.path.join(self.output_dir, file_name), mode="w+", dtype=self.dtype, shape=(num_lines, LINE_LENGTH)
+        )
+        self.shard_lines = 0
+
+    def _close_shard(self):
+        if self.shard is not None:
+            self.shard.flush()
+            self.shard = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.text_file is not None:
+            self.text_file.close()
+
+
+def load_manifest(corpus_dir):
+    with open(os.path.join(corpus_dir, MANIFEST_FILE)) as f:
+        return json.load(f)
+
+
+def _make_block(make_lines, num_lines, seed_sequence):
+    return make_lines(num_lines, np.random.default_rng(seed_sequence))
+
+
+def generate_blocks(make_lines, num_lines, seed_sequence, num_workers=1):
+    """
+    Calls `make_lines(block_lines, rng)` for consecutive blocks of CHUNK_LINES lines and yields the results in order.
+    Every block gets its own generator, spawned from `seed_sequence`, so the corpus only depends on the seed, not on
+    how many workers made it. With `num_workers > 1` the blocks are made in a process pool, a few blocks ahead of the
+    consumer at most.
+    """
+    block_sizes = [min(CHUNK_LINES, num_lines - start) for start in range(0, num_lines, CHUNK_LINES)]
+    block_seeds = seed_sequence.spawn(len(block_sizes))
+    if num_workers <= 1:
+        for block_lines, block_seed in zip(block_sizes, block_seeds):
+            yield _make_block(make_lines, block_lines, block_seed)
+        return
+
+    with ProcessPoolExecutor(num_workers) as executor:
+        pending = deque()
+        for block_lines, block_seed in zip(block_sizes, block_seeds):
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(_make_block, make_lines, block_lines, block_seed))
+        while pending:
+            yield pending.popleft().result()
+
+
+def repeated_positions(len_repeating):
+    """
+    For lines made of segments of `len_repeating` words followed by `len_repeating` words that repeat them (the last
+    segment may be cut short), returns the position each position of a line repeats (itself, in a first half) and
+    whether it is in a second half.
+    """
+    positions = np.arange(LINE_LENGTH)
+    repeats = positions % (2 * len_repeating) >= len_repeating
+    return np.where(repeats, positions - len_repeating, positions), repeats
+
+
+def find_closing_slots(output, rows, closing):
+    """
+    Finds where the closes of the flat dependencies opened on `rows` go: the sampled `closing` index if it is free
+    (< 0 in `output`), else the nearest free slot less than MAX_CLOSING_DISPLACEMENT away, trying left before right at
+    each distance. Returns the chosen indices, -1 where there is none; a close past the end of the line is dropped.
+    """
+    line_length = output.shape[1]
+    slots = np.full(len(rows), -1, dtype=np.int64)
+    in_line = closing < line_length
+    free = in_line & (output[rows, np.minimum(closing, line_length - 1)] < 0)
+    slots[free] = closing[free]
+    for displacement in range(1, MAX_CLOSING_DISPLACEMENT):
+        for candidate in (closing - displacement, closing + displacement):
+            in_range = (candidate >= 0) & (candidate < line_length)
+            found = (slots < 0) & in_line & in_range & (output[rows, np.clip(candidate, 0, line_length - 1)] < 0)
+            slots[found] = candidate[found]
+    return slots
+
+
+def split_seeds(seed, splits=SPLITS):
+    """Returns a SeedSequence for each of `splits`, derived from `seed` (fresh entropy if None)."""
+    seeds = dict(zip(SPLITS, np.random.SeedSequence(seed).spawn(len(SPLITS))))
+    return {split: seeds[split] for split in splits}
+
+
+def generate_split(output_dir, split, num_lines, vocab_size, make_lines, seed_sequence, num_workers=1, text=False):
+    """
+    Makes a split of `num_lines` lines with `make_lines(block_lines, rng)` and writes it with a CorpusWriter, block by
+    block (see generate_blocks). `make_lines` has to be picklable to run on more than one worker, e.g. a partial of a
+    module-level function. If it returns a tuple, the first element is the lines and the rest are per-block stats,
+    which are summed over the split and returned.
+    """
+    stats = None
+    num_blocks = -(-num_lines // CHUNK_LINES)
+    with CorpusWriter(output_dir, split, num_lines, vocab_size, text=text) as writer:
+        blocks = generate_blocks(make_lines, num_lines, seed_sequence, num_workers=num_workers)
+        for block in tqdm(blocks, total=num_blocks, desc="[Generating samples]"):
+            if isinstance(block, tuple):
+                block, block_stats = block[0], block[1:]
+                stats = block_stats if stats is None else tuple(a + b for a, b in zip(stats, block_stats))
+            writer.write(block)
+    return stats
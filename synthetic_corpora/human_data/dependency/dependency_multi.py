@@ -4,22 +4,18 @@ from tqdm import tqdm
 from multiprocessing import Process
 from stanza.pipeline.core import DownloadMethod
 
+import sys
+sys.path.append('../../..')
+from crossing import find_crossing_arcs
+
 GPUS = [0, 1, 2, 3]
 INPUT_FILE = "../wiki_cleaned_output/dependency.txt"
 OUTPUT_BASE = "../wiki_encoded_output/dependency_split"
 os.makedirs(OUTPUT_BASE, exist_ok=True)
 
 def count_crossing_arcs(sentence):
-    count = 0
-    for i, wi in enumerate(sentence.words):
-        for j, wj in enumerate(sentence.words):
-            if wi.head == 0 or wj.head == 0 or i == j:
-                continue
-            ai, bi = sorted([i, wi.head - 1])
-            aj, bj = sorted([j, wj.head - 1])
-            if (ai < aj < bi < bj) or (aj < ai < bj < bi):
-                count += 1
-    return count // 2
+    arcs = [(*sorted([i, word.head - 1]), i) for i, word in enumerate(sentence.words) if word.head != 0]
+    return find_crossing_arcs(arcs)[1]
 
 def replace_pairs_with_random(s: str):
     nums = list(map(int, s.strip().split()))
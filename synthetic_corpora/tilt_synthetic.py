@@ -11,8 +11,10 @@ You can add new entries to the BUILDER_CONFIGS list following the pattern
 Instructions about what this type of script is are here https://huggingface.co/docs/datasets/dataset_script
 """
 
+import json
 import os
 import datasets
+import numpy as np
 
 _DESCRIPTION = """\
     Parentheses datasets for testing synthetic languages things!
@@ -21,6 +23,8 @@ _DESCRIPTION = """\
 # otherwise. This directory should point to the data directory in this dir, but the 
 # absolute path from your machine
 _DATA_DIR = "synthetic_corpora/data"
+# Written by the corpus creation scripts next to their .npy shards (the {split}.txt files only exist with --text)
+_MANIFEST_FILE = "manifest.json"
 
 class SyntheticConfig(datasets.BuilderConfig):
 
@@ -181,19 +185,23 @@ class Synthetic(datasets.GeneratorBasedBuilder):
         return [
             datasets.SplitGenerator(
                 name=datasets.Split.TRAIN,
-                gen_kwargs={"data_file": os.path.join(self.config.data_dir, "train.txt"), "split": "train"},
+                gen_kwargs={"data_dir": self.config.data_dir, "split": "train"},
             ),
             datasets.SplitGenerator(
                 name=datasets.Split.TEST,
-                gen_kwargs={"data_file": os.path.join(self.config.data_dir, "test.txt"), "split": "test"},
+                gen_kwargs={"data_dir": self.config.data_dir, "split": "test"},
             ),
             datasets.SplitGenerator(
                 name=datasets.Split.VALIDATION,
-                gen_kwargs={"data_file": os.path.join(self.config.data_dir, "valid.txt"), "split": "valid"},
+                gen_kwargs={"data_dir": self.config.data_dir, "split": "valid"},
             )
         ]
 
-    def _generate_examples(self, data_file, split):
+    def _generate_examples(self, data_dir, split):
+        data_file = os.path.join(data_dir, f"{split}.txt")
+        if not os.path.exists(data_file):
+            yield from self._generate_examples_from_shards(data_dir, split)
+            return
         with open(data_file, encoding="utf-8") as f:
             for idx, row in enumerate(f):
                 row = row.strip()
@@ -201,3 +209,15 @@ class Synthetic(datasets.GeneratorBasedBuilder):
                     yield idx, {"text": row}
                 else:
                     yield idx, {"text": ""}
+
+    def _generate_examples_from_shards(self, data_dir, split):
+        # the same lines as {split}.txt, read back from the .npy shards the corpus creation scripts write by default
+        with open(os.path.join(data_dir, _MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        idx = 0
+        for shard in manifest["splits"][split]["shards"]:
+            lines = np.load(os.path.join(data_dir, shard["file_name"]), mmap_mode="r")
+            for start in range(0, len(lines), 1000):
+                for row in lines[start : start + 1000].tolist():
+                    yield idx, {"text": " ".join(map(str, row))}
+                    idx += 1
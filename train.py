@@ -199,6 +199,10 @@ def load_datasets(quinfig, paths, tokenizer, overwatch):
         seq_len=quinfig.model.seq_len,
         preprocessing_num_proc=quinfig.dataset.num_proc,
         shuffle_seed=quinfig.seed,
+        train_shuffle=quinfig.dataset.shuffle,
+        map_style=quinfig.dataset.map_style,
+        cache_format=quinfig.dataset.cache_format,
+        prefetch_depth=quinfig.dataset.prefetch_depth,
     )
 
     # Load Online Eval Datasets